@@ -0,0 +1,78 @@
+# Standard library imports
+import hashlib
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+# Third party imports
+from aiohttp import web
+
+# Local imports
+from parsing import CHUNK_SIZE, FORMAT_CSV, FORMAT_JSON, FORMAT_TEXT, parse_channel_stream
+
+# Looks up the user id of an API token, None for unknown tokens.
+Authenticate = Callable[[str], Awaitable[Optional[int]]]
+# Checks the channels of a request for a user and passes every result to `emit`.
+CheckStream = Callable[[int, AsyncIterator[List[str]], Callable[[dict], Awaitable[None]]], Awaitable[None]]
+
+
+def hash_token(token: str) -> str:
+    """Tokens are stored hashed, so the database does not give them away."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def request_format(content_type: str) -> str:
+    if content_type == "application/json":
+        return FORMAT_JSON
+    if content_type == "text/csv":
+        return FORMAT_CSV
+    return FORMAT_TEXT
+
+
+async def _body_chunks(request: web.Request) -> AsyncIterator[bytes]:
+    async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+        yield chunk
+
+
+def create_api_app(authenticate: Authenticate, check_stream: CheckStream) -> web.Application:
+    """Builds the batch-check API.
+
+    `POST /check` with `Authorization: Bearer <token>` takes a channel list
+    in any format the bot understands (plain text, CSV or JSON, chosen by
+    the Content-Type) and answers with one NDJSON line per channel as soon
+    as it is checked.
+    """
+
+    async def check_handler(request: web.Request) -> web.StreamResponse:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        user_id = await authenticate(token.strip()) if scheme.lower() == "bearer" and token.strip() else None
+        if user_id is None:
+            raise web.HTTPUnauthorized(text="Send a valid token as 'Authorization: Bearer <token>'.\n")
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        async def emit(row: dict):
+            # Waits while the client is not reading, which slows the checks down.
+            await response.write((json.dumps(row, ensure_ascii=False) + "\n").encode())
+
+        batches = parse_channel_stream(_body_chunks(request), request_format(request.content_type))
+        logging.info(f"API request from user {user_id}...")
+        await check_stream(user_id, batches, emit)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/check", check_handler)
+    return app
+
+
+async def start_api_server(host: str, port: int, authenticate: Authenticate, check_stream: CheckStream) -> web.AppRunner:
+    """Serves the batch-check API on http://host:port/check."""
+
+    logging.info(f"Starting API server on {host}:{port}...")
+    runner = web.AppRunner(create_api_app(authenticate, check_stream))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("API server started.")
+    return runner
@@ -0,0 +1,344 @@
+"""End-to-end benchmark of the bot against a simulated Telegram backend.
+
+The Telethon clients and the aiogram Bot are replaced by local fakes with
+configurable latency, flood-wait injection and a mix of channels with open
+comments, closed comments and usernames that do not exist. Every run drives
+`check_channels`, `handle_text` or `handle_file` in a fresh process with a
+fresh database and reports throughput, p50/p99 per-channel latency, peak RSS
+and Bot API calls per channel.
+
+Usage: python benchmarks/bench_bot.py [--sizes 100,1000,10000,100000] [--scenarios check_channels,handle_text]
+       [--latency 50] [--flood-rate 0.001] [--accounts 2] [--workers 0] [--passes 2]
+"""
+
+# Standard library imports
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types as pytypes
+import zlib
+from collections import Counter
+from contextlib import asynccontextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ("check_channels", "handle_text", "handle_file")
+ADMIN_ID = 1
+USER_ID = 1000
+CHAT_ID = 1000
+
+
+class FakeTelegram:
+    """The simulated Telegram backend shared by all fake clients."""
+
+    def __init__(self, latency: float, jitter: float, flood_rate: float, flood_seconds: int, mix, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.mix = mix
+        self.seed = seed
+        self.calls = Counter()
+        self.flood_waits = 0
+
+    def _fraction(self, key: str) -> float:
+        return zlib.crc32(f"{self.seed}:{key}".encode()) / 2 ** 32
+
+    def status(self, username: str) -> str:
+        """Returns 'open', 'closed' or 'missing' for a username, always the same one."""
+
+        value = self._fraction(username)
+        opened, closed, _ = self.mix
+        total = sum(self.mix)
+        if value < opened / total:
+            return "open"
+        if value < (opened + closed) / total:
+            return "closed"
+        return "missing"
+
+    async def call(self, method: str, key: str):
+        from telethon.errors.rpcerrorlist import FloodWaitError
+
+        self.calls[method] += 1
+        delay = self.latency * (1 + self.jitter * (self._fraction(f"{method}:{key}:{self.calls[method]}") * 2 - 1))
+        await asyncio.sleep(max(delay, 0))
+        if self.flood_rate and self._fraction(f"flood:{method}:{self.calls[method]}") < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(None, capture=self.flood_seconds)
+
+
+class FakeClient:
+    """Stands in for a logged in TelegramClient."""
+
+    def __init__(self, telegram: FakeTelegram, name: str):
+        self.telegram = telegram
+        self.name = name
+        self.channels = {}
+
+    def _channel(self, username: str):
+        from telethon.tl.types import Channel, ChatPhotoEmpty
+
+        channel_id = zlib.crc32(username.encode())
+        return Channel(id=channel_id, title=username[1:].title(), photo=ChatPhotoEmpty(), date=None,
+                       username=username[1:], access_hash=channel_id ^ zlib.crc32(self.name.encode()))
+
+    async def get_entity(self, username: str):
+        from telethon.errors.rpcerrorlist import UsernameNotOccupiedError
+
+        username = username.lower()
+        await self.telegram.call("get_entity", username)
+        if self.telegram.status(username) == "missing":
+            raise UsernameNotOccupiedError(None)
+        channel = self._channel(username)
+        self.channels[channel.id] = channel
+        return channel
+
+    async def __call__(self, request):
+        # A container costs one round trip no matter how many requests it holds.
+        if isinstance(request, list):
+            await self.telegram.call("container", str(len(request)))
+            self.telegram.calls["GetFullChannelRequest"] += len(request)
+            return [self._full_channel(item) for item in request]
+        await self.telegram.call("GetFullChannelRequest", str(request.channel))
+        return self._full_channel(request)
+
+    def _full_channel(self, request):
+        channel_id = getattr(request.channel, "channel_id", None) or request.channel.id
+        channel = self.channels[channel_id]
+        opened = self.telegram.status("@" + channel.username.lower()) == "open"
+        return pytypes.SimpleNamespace(full_chat=pytypes.SimpleNamespace(linked_chat_id=channel_id if opened else None),
+                                       chats=[channel])
+
+    def is_connected(self):
+        return True
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+class FakeBot:
+    """Stands in for the aiogram Bot and counts every Bot API call."""
+
+    def __init__(self, latency: float, files: dict):
+        self.latency = latency
+        self.files = files
+        self.calls = Counter()
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("sendMessage")
+        return FakeMessage(self, chat_id, USER_ID, text)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._call("sendDocument")
+        document.file.read()
+
+    async def get_file(self, file_id):
+        await self._call("getFile")
+        return pytypes.SimpleNamespace(file_path=file_id)
+
+    def get_file_url(self, file_path):
+        return file_path
+
+    async def get_session(self):
+        return self
+
+    @asynccontextmanager
+    async def get(self, url):
+        from parsing import CHUNK_SIZE
+
+        data = self.files[url]
+
+        async def iter_chunked(size):
+            for offset in range(0, len(data), CHUNK_SIZE):
+                yield data[offset:offset + CHUNK_SIZE]
+
+        yield pytypes.SimpleNamespace(raise_for_status=lambda: None,
+                                      content=pytypes.SimpleNamespace(iter_chunked=iter_chunked))
+
+    async def close(self):
+        pass
+
+
+class FakeMessage:
+    message_id = 1
+
+    def __init__(self, bot: FakeBot, chat_id: int, user_id: int, text: str = None, document=None, caption=None):
+        self.bot = bot
+        self.chat = pytypes.SimpleNamespace(id=chat_id)
+        self.from_user = pytypes.SimpleNamespace(id=user_id, username="bench", first_name="Bench", last_name=None)
+        self.text = text
+        self.document = document
+        self.caption = caption
+
+    async def reply(self, text, **kwargs):
+        await self.bot._call("sendMessage")
+        return FakeMessage(self.bot, self.chat.id, self.from_user.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot._call("editMessageText")
+
+
+def channel_names(count: int):
+    return [f"@bench{i:07d}" for i in range(count)]
+
+
+def import_main():
+    import main
+
+    main.create_app()
+    return main
+
+
+async def run_single(args) -> dict:
+    main = import_main()
+    telegram = FakeTelegram(args.latency / 1000, args.jitter, args.flood_rate, args.flood_seconds,
+                            [int(part) for part in args.mix.split(":")])
+    channels = channel_names(args.size)
+    text = "\n".join(channels)
+    bot = FakeBot(args.bot_latency / 1000, {"channels.txt": text.encode()})
+    main.BOT = bot
+
+    from clients import PooledClient
+
+    limits = ((main.GET_ENTITY_RATE, main.GET_ENTITY_BURST), (main.FULL_CHANNEL_RATE, main.FULL_CHANNEL_BURST))
+    main.CLIENT_POOL.clients = [PooledClient(f"fake{i}", FakeClient(telegram, f"fake{i}"), *limits)
+                                for i in range(args.accounts)]
+    main.CLIENT_POOL.start = lambda: asyncio.sleep(0)
+
+    latencies = []
+    handle_channel_processing = main.handle_channel_processing
+
+    async def timed(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return await handle_channel_processing(*a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    main.handle_channel_processing = timed
+
+    await main.on_startup(None)
+    passes = []
+    try:
+        for _ in range(args.passes):
+            bot.calls.clear()
+            telegram.calls.clear()
+            telegram.flood_waits = 0
+            latencies.clear()
+            if args.scenario == "check_channels":
+                message = FakeMessage(bot, CHAT_ID, USER_ID)
+                call = main.check_channels(channels, message)
+            elif args.scenario == "handle_text":
+                call = main.handle_text(FakeMessage(bot, CHAT_ID, USER_ID, text))
+            else:
+                document = pytypes.SimpleNamespace(file_id="channels.txt", file_name="channels.txt")
+                call = main.handle_file(FakeMessage(bot, CHAT_ID, USER_ID, document=document))
+
+            start = time.perf_counter()
+            await call
+            elapsed = time.perf_counter() - start
+
+            latencies.sort()
+            passes.append({
+                "seconds": elapsed,
+                "throughput": args.size / elapsed,
+                "p50": latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                "p99": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+                "bot_calls": sum(bot.calls.values()) / args.size,
+                "rpc_calls": sum(telegram.calls.values()) / args.size,
+                "flood_waits": telegram.flood_waits,
+            })
+    finally:
+        await main.on_shutdown(None)
+
+    return {"scenario": args.scenario, "size": args.size, "passes": passes,
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def child_env(args, database: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_API_ID": "1",
+        "TELEGRAM_API_HASH": "bench",
+        "TELEGRAM_USER_ID": str(ADMIN_ID),
+        "DB_NAME": database,
+        "METRICS_PORT": "0",
+        "BOT_MODE": "polling",
+        "ROLE": "all",
+        "DAILY_QUOTA": "0",
+        "GET_ENTITY_RATE": str(args.rate),
+        "GET_ENTITY_BURST": str(args.burst),
+        "FULL_CHANNEL_RATE": str(args.rate),
+        "FULL_CHANNEL_BURST": str(args.burst),
+        "CHECK_WORKERS": str(args.workers),
+    })
+    for name in [name for name in env if name.startswith("TELEGRAM_BOT_TOKEN")]:
+        del env[name]
+    for i in range(1, args.accounts + 1):
+        env[f"TELEGRAM_BOT_TOKEN{i}"] = f"{i}:bench"
+    env["TELEGRAM_BOT_TOKEN12"] = env["TELEGRAM_BOT_TOKEN1"]
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="100,1000,10000,100000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=50, help="mean Telethon RPC latency, ms")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency spread as a fraction of the mean")
+    parser.add_argument("--bot-latency", type=float, default=30, help="Bot API latency, ms")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of RPCs that raise FloodWaitError")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--mix", default="40:40:20", help="open:closed:nonexistent ratio")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=0, help="check workers, 0 for the bot's default")
+    parser.add_argument("--rate", type=float, default=1000, help="per-account request rate limit")
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--passes", type=int, default=1, help="repeat the job to measure warm-cache runs")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--single", nargs=2, metavar=("SCENARIO", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+        args.scenario, args.size = args.single[0], int(args.single[1])
+        print(json.dumps(asyncio.run(run_single(args))))
+        return
+
+    print(f"{'scenario':<15}{'size':>8}{'pass':>5}{'seconds':>9}{'ch/s':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'RSS MiB':>9}{'bot/ch':>8}{'rpc/ch':>8}{'floods':>7}")
+    for scenario in args.scenarios.split(","):
+        for size in (int(size) for size in args.sizes.split(",")):
+            with tempfile.TemporaryDirectory() as directory:
+                command = [sys.executable, os.path.abspath(__file__), "--single", scenario, str(size)]
+                command += sys.argv[1:]
+                result = subprocess.run(command, env=child_env(args, os.path.join(directory, "bench.db")), cwd=directory,
+                                        stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL,
+                                        text=True)
+            if result.returncode:
+                print(f"{scenario:<15}{size:>8}  failed with exit code {result.returncode}")
+                continue
+            report = json.loads(result.stdout.strip().splitlines()[-1])
+            for number, run in enumerate(report['passes'], start=1):
+                print(f"{scenario:<15}{size:>8}{number:>5}{run['seconds']:>9.2f}{run['throughput']:>9.0f}"
+                      f"{run['p50']:>9.1f}{run['p99']:>9.1f}{report['peak_rss_mib']:>9.0f}"
+                      f"{run['bot_calls']:>8.3f}{run['rpc_calls']:>8.2f}{run['flood_waits']:>7}")
+
+
+if __name__ == "__main__":
+    main()
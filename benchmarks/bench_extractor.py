@@ -0,0 +1,68 @@
+"""Micro-benchmark for the username extractor.
+
+Builds a synthetic channel list with a mix of tgstat links, t.me links,
+@mentions, bare usernames and noise, then measures how fast it is parsed.
+
+Usage: python benchmarks/bench_extractor.py [lines]
+"""
+
+# Standard library imports
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local imports
+from extractor import extract_usernames, is_valid_username
+from parsing import CHUNK_SIZE, ChannelStreamParser
+
+TEMPLATES = (
+    "https://tgstat.ru/channel/@{}/stat",
+    "https://t.me/{}",
+    "telegram.me/s/{}",
+    "@{}",
+    "{}",
+    "Channel @{} has 1200 subscribers",
+)
+
+
+def generate_lines(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + "_"
+    for _ in range(count):
+        length = rng.randint(3, 34)
+        name = rng.choice(string.ascii_letters) + "".join(rng.choices(alphabet, k=length - 1))
+        yield rng.choice(TEMPLATES).format(name)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    text = "\n".join(generate_lines(count))
+    data = text.encode()
+    print(f"{count} lines, {len(data) / 1024 / 1024:.1f} MiB")
+
+    start = time.perf_counter()
+    usernames = extract_usernames(text)
+    elapsed = time.perf_counter() - start
+    print(f"extract_usernames: {elapsed:.2f} s, {count / elapsed:,.0f} lines/s, {len(usernames)} unique")
+
+    start = time.perf_counter()
+    valid = sum(1 for username in usernames if is_valid_username(username))
+    elapsed = time.perf_counter() - start
+    print(f"is_valid_username: {elapsed:.2f} s, {len(usernames) / elapsed:,.0f} names/s, {valid} valid")
+
+    start = time.perf_counter()
+    parser = ChannelStreamParser()
+    streamed = 0
+    for offset in range(0, len(data), CHUNK_SIZE):
+        streamed += len(parser.feed(data[offset:offset + CHUNK_SIZE]))
+    streamed += len(parser.close())
+    elapsed = time.perf_counter() - start
+    print(f"ChannelStreamParser: {elapsed:.2f} s, {count / elapsed:,.0f} lines/s, {streamed} unique")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Multi-process check of the SQLite task queue.
+
+Fills a fresh database with jobs, then starts worker processes that lease
+tasks through SQLiteTaskQueue and complete them, the way `run_worker`
+does, while every worker also keeps writing to the shared connection (as
+the watch scheduler and the API do). Fails when a task is leased twice,
+left unfinished or a lease fails, and reports the tasks completed per
+second.
+
+With --finished, a finished job of that many tasks is left in the tables
+first, the way old jobs pile up between cleanups, and the lease latency
+shows whether it slows the queue down.
+
+Usage: python benchmarks/bench_queue.py [--workers 4] [--jobs 5] [--tasks 2000] [--batch 50] [--finished 0]
+"""
+
+# Standard library imports
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Local imports
+from cache import STATUS_OPEN
+from database import DATABASE, open_connection
+from jobs import (CREATE_JOB_TASKS_INDEX, CREATE_JOB_TASKS_ORDER_INDEX, CREATE_JOB_TASKS_TABLE,
+                  CREATE_JOBS_STATUS_INDEX, CREATE_JOBS_TABLE, JOB_DONE, TASK_DONE, count_results, count_tasks,
+                  set_job_status)
+from taskqueue import SQLiteTaskQueue
+from watch import CREATE_WATCHED_CHANNELS_TABLE, update_watched, watch_channels
+
+WATCHED = 100
+
+
+async def create_database(path: str, jobs: int, tasks: int, finished: int) -> list:
+    await DATABASE.connect(path)
+    db = DATABASE.connection
+    for statement in (CREATE_JOBS_TABLE, CREATE_JOBS_STATUS_INDEX, CREATE_JOB_TASKS_TABLE, CREATE_JOB_TASKS_INDEX,
+                      CREATE_JOB_TASKS_ORDER_INDEX, CREATE_WATCHED_CHANNELS_TABLE):
+        await db.execute(statement)
+    await db.commit()
+    await watch_channels(db, 1, [f"@watched{i}" for i in range(WATCHED)], 0)
+    queue = SQLiteTaskQueue(await open_connection(path), "setup", 600, 3)
+    if finished:
+        job_id = await queue.create_job(0, [f"@finished{i}" for i in range(finished)], None, False, 0)
+        await db.execute("UPDATE job_tasks SET status = ? WHERE job_id = ?", (TASK_DONE, job_id))
+        await set_job_status(db, job_id, JOB_DONE)
+    job_ids = [await queue.create_job(job, [f"@job{job}task{i}" for i in range(tasks)], None, False, job % 3)
+               for job in range(jobs)]
+    await queue.close()
+    await DATABASE.close()
+    return job_ids
+
+
+async def work(path: str, owner: str, batch: int):
+    """Leases and completes tasks until the queue stays empty; prints what was leased."""
+
+    await DATABASE.connect(path)
+    queue = SQLiteTaskQueue(await open_connection(path), owner, 600, 3)
+    leased, latencies, failures, done = [], [], 0, False
+
+    async def write_shared():
+        i = 0
+        while not done:
+            await update_watched(DATABASE.connection, f"@watched{i % WATCHED}", STATUS_OPEN)
+            i += 1
+            await asyncio.sleep(0)
+
+    writer = asyncio.create_task(write_shared())
+    empty = 0
+    while empty < 3:
+        try:
+            start = time.perf_counter()
+            tasks = await queue.lease(batch)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            print(f"{owner}: lease failed: {e}", file=sys.stderr)
+            failures += 1
+            if failures >= 10:
+                break
+            continue
+        empty = 0 if tasks else empty + 1
+        for task in tasks:
+            leased.append(task['username'])
+            await queue.complete(task, STATUS_OPEN)
+        if not tasks:
+            await asyncio.sleep(0.05)
+    done = True
+    await writer
+    await queue.close()
+    await DATABASE.close()
+    print(json.dumps({"leased": leased, "latencies": latencies, "failures": failures}))
+
+
+async def count_finished(path: str, job_ids: list):
+    db = await open_connection(path)
+    total = finished = 0
+    for job_id in job_ids:
+        total += await count_tasks(db, job_id)
+        finished += await count_results(db, job_id)
+    await db.close()
+    return total, finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--tasks", type=int, default=2000, help="tasks per job")
+    parser.add_argument("--batch", type=int, default=50, help="tasks per lease")
+    parser.add_argument("--finished", type=int, default=0, help="tasks of a finished job left in the tables")
+    parser.add_argument("--work", nargs=2, metavar=("PATH", "OWNER"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.work:
+        asyncio.run(work(*args.work, args.batch))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "queue.db")
+        job_ids = asyncio.run(create_database(path, args.jobs, args.tasks, args.finished))
+        start = time.perf_counter()
+        processes = [subprocess.Popen([sys.executable, __file__, "--batch", str(args.batch), "--work", path,
+                                       f"worker{i}"], stdout=subprocess.PIPE, text=True)
+                     for i in range(args.workers)]
+        outputs = [json.loads(process.communicate()[0]) for process in processes]
+        elapsed = time.perf_counter() - start
+        total, finished = asyncio.run(count_finished(path, job_ids))
+
+    leases = Counter(username for output in outputs for username in output['leased'])
+    twice = [username for username, count in leases.items() if count > 1]
+    failures = sum(output['failures'] for output in outputs)
+    per_worker = ", ".join(str(len(output['leased'])) for output in outputs)
+    latencies = sorted(latency for output in outputs for latency in output['latencies'])
+    print(f"{args.workers} workers, {total} tasks: {finished} finished in {elapsed:.2f} s "
+          f"({finished / elapsed:.0f} tasks/s), leased per worker: {per_worker}")
+    print(f"lease latency: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    print(f"leased twice: {len(twice)}, failed leases: {failures}, unfinished: {total - finished}")
+    if twice or failures or finished != total:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Memory benchmark for the per-job check results.
+
+Fills the opened/closed/errors dicts of one job the way `_run_job` does,
+once with Telethon `Channel` entities and a formatted error string per
+failure (as before) and once with `ChannelResult` records and interned
+error reasons, and reports the bytes held per channel.
+
+Usage: python benchmarks/bench_results.py [channels]
+"""
+
+# Standard library imports
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Third party imports
+from telethon.tl.types import Channel, ChatPhotoEmpty
+
+# Local imports
+from cache import STATUS_CLOSED, STATUS_OPEN
+from records import ChannelResult, error_reason, exception_reason
+
+
+def channel_names(count: int):
+    return [f"@bench{i:07d}" for i in range(count)]
+
+
+def old_results(usernames):
+    opened_comments, closed_comments, errors = {}, {}, {}
+    for i, username in enumerate(usernames):
+        kind = i % 10
+        if kind < 8:
+            channel = Channel(id=1_000_000_000 + i, title=f"Bench channel {i}", photo=ChatPhotoEmpty(),
+                              date=datetime.now(timezone.utc), username=username[1:], access_hash=i * 7919,
+                              broadcast=True, has_link=kind < 4)
+            (opened_comments if kind < 4 else closed_comments)[username] = channel
+        elif kind == 8:
+            errors[username] = "Username not occupied"
+        else:
+            errors[username] = f"Error while processing {username}: No user has \"{username[1:]}\" as username"
+    return opened_comments, closed_comments, errors
+
+
+def new_results(usernames):
+    opened_comments, closed_comments, errors = {}, {}, {}
+    for i, username in enumerate(usernames):
+        kind = i % 10
+        if kind < 8:
+            status = STATUS_OPEN if kind < 4 else STATUS_CLOSED
+            result = ChannelResult(username, 1_000_000_000 + i, f"Bench channel {i}", status)
+            (opened_comments if kind < 4 else closed_comments)[username] = result
+        elif kind == 8:
+            errors[username] = error_reason("Username not occupied")
+        else:
+            errors[username] = exception_reason(ValueError(f"No user has \"{username[1:]}\" as username"))
+    return opened_comments, closed_comments, errors
+
+
+def measure(build, usernames) -> int:
+    gc.collect()
+    tracemalloc.start()
+    results = build(usernames)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    # The usernames are owned by the job either way and are not counted.
+    usernames = channel_names(count)
+    print(f"{count} channels (40% open, 40% closed, 20% errors)")
+    for name, build in (("Channel entities", old_results), ("ChannelResult", new_results)):
+        size = measure(build, usernames)
+        print(f"{name:<18}{size / 1024 / 1024:>8.1f} MiB{size / count:>8.0f} bytes/channel")
+
+
+if __name__ == "__main__":
+    main()
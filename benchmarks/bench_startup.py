@@ -0,0 +1,51 @@
+"""Startup-time benchmark.
+
+Measures, each in a fresh interpreter, how long it takes to import the
+helper modules, to import main and to build the app with create_app.
+
+Usage: python benchmarks/bench_startup.py [runs]
+"""
+
+# Standard library imports
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = (
+    ("import utilities", "import utilities"),
+    ("import extractor, parsing", "import extractor, parsing"),
+    ("import main", "import main"),
+    ("main.create_app()", "import main; main.create_app()"),
+)
+
+TIMER = """
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code: str, env: dict, cwd: str) -> float:
+    result = subprocess.run([sys.executable, "-c", TIMER.format(root=ROOT, code=code)], env=env, cwd=cwd,
+                            stdout=subprocess.PIPE, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = dict(os.environ, TELEGRAM_API_ID="1", TELEGRAM_API_HASH="bench", TELEGRAM_USER_ID="1",
+               TELEGRAM_BOT_TOKEN12="1:bench", METRICS_PORT="0")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, code in STEPS:
+            times = [measure(code, env, directory) for _ in range(runs)]
+            print(f"{name:<28}{statistics.median(times) * 1000:>8.1f} ms (median of {runs})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Standard library imports
+import time
+from typing import Optional
+
+STATUS_OPEN = "open"
+STATUS_CLOSED = "closed"
+STATUS_ERROR = "error"
+
+CREATE_CHANNEL_STATUS_TABLE = """
+    CREATE TABLE IF NOT EXISTS channel_status (
+        username TEXT PRIMARY KEY,
+        channel_id INTEGER,
+        title TEXT,
+        linked_chat_id INTEGER,
+        status TEXT NOT NULL,
+        error TEXT,
+        checked_at REAL NOT NULL
+    )
+"""
+
+
+async def get_cached_status(db, username: str, ttl: float, error_ttl: float) -> Optional[dict]:
+    """Returns the cached check result for a username if it is still fresh."""
+
+    cursor = await db.execute(
+        "SELECT username, channel_id, title, linked_chat_id, status, error, checked_at "
+        "FROM channel_status WHERE username = ?", (username.lower(),))
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return None
+
+    status = row[4]
+    max_age = error_ttl if status == STATUS_ERROR else ttl
+    if time.time() - row[6] > max_age:
+        return None
+
+    return {"username": row[0], "id": row[1], "title": row[2],
+            "linked_chat_id": row[3], "status": status, "error": row[5],
+            "checked_at": row[6]}
+
+
+async def save_status(db, username: str, status: str, channel_id: int = None, title: str = None,
+                      linked_chat_id: int = None, error: str = None):
+    """Stores the outcome of a channel check, replacing any older result."""
+
+    await db.execute('''
+        INSERT OR REPLACE INTO channel_status(username, channel_id, title, linked_chat_id, status, error, checked_at)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
+    ''', (username.lower(), channel_id, title, linked_chat_id, status, error, time.time()))
+    await db.commit()
@@ -0,0 +1,168 @@
+# Standard library imports
+import asyncio
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
+
+# Third party imports
+from telethon import TelegramClient
+from telethon.errors.rpcerrorlist import FloodWaitError
+
+# Local imports
+from engine import TokenBucket
+from entities import RequestBatcher
+
+
+def load_bot_tokens() -> List[str]:
+    """Returns every TELEGRAM_BOT_TOKENn value from the environment, ordered by n."""
+
+    tokens = []
+    for name, value in os.environ.items():
+        match = re.fullmatch(r"TELEGRAM_BOT_TOKEN(\d+)", name)
+        if match and value and ":" in value:
+            tokens.append((int(match.group(1)), value))
+    return list(dict.fromkeys(token for _, token in sorted(tokens)))
+
+
+class PooledClient:
+    """A logged in Telethon client together with its rate limits and counters."""
+
+    def __init__(self, name: str, client: TelegramClient, get_entity_limits: Tuple[float, int],
+                 full_channel_limits: Tuple[float, int]):
+        self.name = name
+        self.client = client
+        self.batcher = RequestBatcher(client)
+        self.get_entity_limiter = TokenBucket(*get_entity_limits)
+        self.full_channel_limiter = TokenBucket(*full_channel_limits)
+        self.in_use = 0
+        self.healthy = True
+        self.suspended_until = 0.0
+        self.resume_at = 0.0
+        self.requests = 0
+        self.checks = 0
+        self.flood_waits = 0
+
+    @property
+    def suspended(self) -> bool:
+        return time.monotonic() < self.suspended_until
+
+    def budget(self) -> float:
+        """Returns how many more checks this account could start right now."""
+        return min(self.get_entity_limiter.available(),
+                   self.full_channel_limiter.available()) - self.in_use
+
+    def suspend(self, seconds: float):
+        """Takes the account out of rotation after a FloodWaitError."""
+        self.flood_waits += 1
+        self.suspended_until = max(self.suspended_until, time.monotonic() + seconds)
+        self.resume_at = max(self.resume_at, time.time() + seconds)
+        logging.warning(f"Client {self.name} suspended for {seconds} seconds.")
+
+    def stats(self) -> str:
+        state = "suspended" if self.suspended else "healthy" if self.healthy else "unhealthy"
+        return (f"{self.name}: {state}, checks: {self.checks}, requests: {self.requests}, "
+                f"flood waits: {self.flood_waits}, in use: {self.in_use}")
+
+
+class ClientPool:
+    """Long-lived Telethon clients, one per bot token, shared by all check workers.
+
+    Every client has its own rate limits, so checks are spread across all
+    configured bot accounts instead of going through a single one.
+    """
+
+    def __init__(self, api_id, api_hash, tokens: List[str], session_prefix: str, health_check_interval: float = 60,
+                 get_entity_limits: Tuple[float, int] = (1, 5), full_channel_limits: Tuple[float, int] = (1, 5)):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.tokens = tokens
+        self.session_prefix = session_prefix
+        self.health_check_interval = health_check_interval
+        self.get_entity_limits = get_entity_limits
+        self.full_channel_limits = full_channel_limits
+        self.clients: List[PooledClient] = []
+        self._health_task = None
+
+    async def start(self):
+        logging.info(f"Starting {len(self.tokens)} Telethon clients...")
+        for token in self.tokens:
+            name = token.split(":")[0]
+            # Every flood-wait is raised, so the account is suspended and the
+            # channel requeued instead of Telethon sleeping inside the call.
+            client = TelegramClient(
+                f"{self.session_prefix}_{name}", self.api_id, self.api_hash, flood_sleep_threshold=0)
+            try:
+                await client.start(bot_token=token)
+            except FloodWaitError as e:
+                logging.error(f"{e.message}:Skipping client {name} for now.")
+                await client.disconnect()
+                continue
+            self.clients.append(PooledClient(
+                name, client, self.get_entity_limits, self.full_channel_limits))
+
+        if not self.clients:
+            raise RuntimeError("No Telethon client could be started.")
+        self._health_task = asyncio.create_task(self._health_loop())
+        logging.info(f"Started {len(self.clients)} Telethon clients.")
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+        for pooled in self.clients:
+            await pooled.client.disconnect()
+        self.clients = []
+        logging.info("Telethon clients closed.")
+
+    async def _ensure_connected(self, pooled: PooledClient):
+        if not pooled.client.is_connected():
+            logging.warning(f"Client {pooled.name} is disconnected, reconnecting...")
+            await pooled.client.connect()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for pooled in self.clients:
+                try:
+                    await self._ensure_connected(pooled)
+                    await pooled.client.get_me()
+                    pooled.healthy = True
+                except Exception as e:
+                    logging.error(f"Health check failed for client {pooled.name}: {e}")
+                    pooled.healthy = False
+
+    def stats(self) -> List[str]:
+        return [pooled.stats() for pooled in self.clients]
+
+    def resume_time(self) -> Optional[float]:
+        """Returns the wall-clock time the first account comes back if every account is suspended."""
+
+        if not self.clients or not all(c.suspended for c in self.clients):
+            return None
+        return min(c.resume_at for c in self.clients)
+
+    @asynccontextmanager
+    async def lease(self):
+        """Yields the account with the most remaining rate budget.
+
+        Suspended accounts are skipped; if every account is suspended this
+        waits for the first one to come back.
+        """
+
+        while True:
+            candidates = [c for c in self.clients if not c.suspended]
+            if candidates:
+                break
+            resume_at = min(c.suspended_until for c in self.clients)
+            await asyncio.sleep(max(resume_at - time.monotonic(), 0))
+
+        candidates = [c for c in candidates if c.healthy] or candidates
+        pooled = max(candidates, key=lambda c: c.budget())
+        await self._ensure_connected(pooled)
+        pooled.in_use += 1
+        try:
+            yield pooled
+        finally:
+            pooled.in_use -= 1
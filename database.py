@@ -0,0 +1,125 @@
+# Standard library imports
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+# Third party imports
+import aiosqlite
+
+# Local imports
+from metrics import DB_WRITE_LATENCY
+
+
+async def ensure_columns(db, table: str, columns: dict):
+    """Adds the given columns to an existing table if they are missing."""
+
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in await cursor.fetchall()}
+    await cursor.close()
+    for name, definition in columns.items():
+        if name not in existing:
+            logging.info(f"Adding column {name} to {table}...")
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    await db.commit()
+
+
+async def open_connection(path: str) -> aiosqlite.Connection:
+    """Opens a connection in WAL mode, so readers do not wait for the writer."""
+
+    connection = await aiosqlite.connect(path)
+    await connection.execute("PRAGMA journal_mode=WAL")
+    await connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Database:
+    """One long-lived SQLite connection shared by the whole bot.
+
+    New users are collected in a write-behind buffer and inserted in
+    batches. For users that are already known only the time they were last
+    seen is kept, and written with the next batch.
+    """
+
+    def __init__(self, flush_interval: float = 5, flush_size: int = 100):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.connection: Optional[aiosqlite.Connection] = None
+        self._known_users = set()
+        self._pending_users = {}
+        self._last_seen = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def connect(self, path: str):
+        logging.info("Connecting to the database...")
+        self.connection = await open_connection(path)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logging.info("Connected to the database.")
+
+    async def load_known_users(self):
+        cursor = await self.connection.execute("SELECT id FROM users")
+        self._known_users.update(row[0] for row in await cursor.fetchall())
+        await cursor.close()
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        if self.connection:
+            await self.flush_users()
+            await self.connection.close()
+            self.connection = None
+        logging.info("Database closed.")
+
+    def add_user(self, user_id: int, username: str, first_name: str, last_name: str):
+        """Queues a user for insertion unless it is already known."""
+
+        now = time.time()
+        if user_id in self._known_users:
+            self._last_seen[user_id] = now
+            return
+        self._known_users.add(user_id)
+        self._pending_users[user_id] = (user_id, username, first_name, last_name, now, now)
+        if len(self._pending_users) >= self.flush_size:
+            asyncio.create_task(self.flush_users())
+
+    async def flush_users(self):
+        async with self._flush_lock:
+            if not (self._pending_users or self._last_seen) or self.connection is None:
+                return
+            pending, self._pending_users = self._pending_users, {}
+            last_seen, self._last_seen = self._last_seen, {}
+            try:
+                with DB_WRITE_LATENCY.time(operation="flush_users"):
+                    await self.connection.executemany('''
+                        INSERT OR IGNORE INTO users(id, username, first_name, last_name, first_seen, last_seen)
+                        VALUES(?, ?, ?, ?, ?, ?)
+                    ''', list(pending.values()))
+                    await self.connection.executemany(
+                        "UPDATE users SET last_seen = ? WHERE id = ?",
+                        [(seen, user_id) for user_id, seen in last_seen.items()])
+                    await self.connection.commit()
+            except Exception:
+                self._pending_users.update(pending)
+                for user_id, seen in last_seen.items():
+                    self._last_seen.setdefault(user_id, seen)
+                raise
+            if pending:
+                logging.info(f"Saved {len(pending)} new users.")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_users()
+            except Exception as e:
+                logging.error(f"Error while saving users: {e}")
+
+
+DATABASE = Database()
+
+
+@asynccontextmanager
+async def get_db():
+    yield DATABASE.connection
@@ -0,0 +1,241 @@
+# Standard library imports
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Iterable
+
+# Third party imports
+from telethon.errors.rpcerrorlist import FloodWaitError
+
+
+class TokenBucket:
+    """Async token bucket that limits how often one kind of request is sent."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        """Returns how many tokens could be taken right now."""
+        if time.monotonic() < self.paused_until:
+            return 0.0
+        self._refill()
+        return self.tokens
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for the given number of seconds."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for transient errors."""
+
+    def __init__(self, attempts: int = 3, backoff: float = 2, max_backoff: float = 300):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt: int) -> float:
+        """Returns how long to wait before the given retry (counted from 1)."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1)
+
+
+class RetryLater(Exception):
+    """Raised by a check to have its channel put back in the queue after `delay` seconds."""
+
+    def __init__(self, delay: float):
+        super().__init__(f"Retry in {delay:.1f} seconds")
+        self.delay = delay
+
+
+PRIORITY_ADMIN = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITY_WATCH = 3
+
+
+class Submission:
+    """Channels of one job waiting for the shared workers."""
+
+    def __init__(self, owner, priority: int, channels: Iterable[str],
+                 check: Callable[[str], Awaitable[None]],
+                 on_checked: Callable[[str], Awaitable[None]],
+                 cancelled: asyncio.Event):
+        self.owner = owner
+        self.priority = priority
+        self.channels = deque(channels)
+        self.pending = len(self.channels)
+        self.check = check
+        self.on_checked = on_checked
+        self.cancelled = cancelled
+        self.in_flight = set()
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class CheckEngine:
+    """Shared pool of workers that interleaves the checks of all running jobs.
+
+    Jobs are grouped by priority; lower values are always served first, so
+    admin jobs jump the queue and small interactive requests are not stuck
+    behind bulk uploads. Within a priority the workers go round-robin over
+    the owners (chat ids), one channel at a time, and each owner's jobs are
+    served in the order they were submitted.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._queues = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of channels that are submitted but not checked yet."""
+        return sum(submission.pending for owners in self._queues.values()
+                   for submissions in owners.values() for submission in submissions)
+
+    def start(self):
+        if not self._tasks:
+            logging.info(f"Starting {self.workers} check workers...")
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logging.info("Check workers stopped.")
+
+    def _add(self, submission: Submission):
+        owners = self._queues.setdefault(submission.priority, OrderedDict())
+        submissions = owners.setdefault(submission.owner, deque())
+        if submission not in submissions:
+            submissions.append(submission)
+        self._wakeup.set()
+
+    def _requeue(self, submission: Submission, channel: str):
+        if submission.cancelled.is_set() or submission.done.done():
+            return
+        submission.channels.append(channel)
+        self._add(submission)
+
+    def _remove(self, submission: Submission):
+        owners = self._queues.get(submission.priority, {})
+        submissions = owners.get(submission.owner)
+        if submissions and submission in submissions:
+            submissions.remove(submission)
+            if not submissions:
+                del owners[submission.owner]
+
+    def _next(self):
+        for priority in sorted(self._queues):
+            owners = self._queues[priority]
+            while owners:
+                owner, submissions = next(iter(owners.items()))
+                submission = submissions[0]
+                if submission.channels:
+                    owners.move_to_end(owner)
+                    return submission, submission.channels.popleft()
+                # Everything of this job is handed out; the rest is in flight.
+                submissions.popleft()
+                if not submissions:
+                    del owners[owner]
+        return None
+
+    async def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            submission, channel = item
+            task = asyncio.ensure_future(submission.check(channel))
+            submission.in_flight.add(task)
+            try:
+                await task
+                await submission.on_checked(channel)
+                submission.pending -= 1
+            except FloodWaitError:
+                # The limiter that hit the flood-wait is already paused,
+                # so the channel simply goes back for a later attempt.
+                self._requeue(submission, channel)
+            except RetryLater as e:
+                asyncio.get_running_loop().call_later(e.delay, self._requeue, submission, channel)
+            except asyncio.CancelledError:
+                if not (submission.cancelled.is_set() or submission.done.done()):
+                    raise
+            except Exception as e:
+                logging.error(f"Error while checking {channel}: {e}")
+                if not submission.done.done():
+                    submission.done.set_exception(e)
+            finally:
+                submission.in_flight.discard(task)
+
+            if submission.pending == 0 and not submission.done.done():
+                submission.done.set_result(None)
+            # Give the handlers of other chats a chance to run between checks.
+            await asyncio.sleep(0)
+
+    async def run(self, channels: Iterable[str],
+                  check: Callable[[str], Awaitable[None]],
+                  on_checked: Callable[[str], Awaitable[None]],
+                  cancelled: asyncio.Event,
+                  owner=None, priority: int = PRIORITY_BULK):
+        """Checks the channels until all are done or `cancelled` is set.
+
+        Cancelling, by `cancelled` or by cancelling the caller, stops checks
+        that are already in flight as well.
+        """
+
+        self.start()
+        submission = Submission(owner, priority, channels, check, on_checked, cancelled)
+        if not submission.pending:
+            return
+        self._add(submission)
+
+        cancel_wait = asyncio.ensure_future(cancelled.wait())
+        try:
+            await asyncio.wait({submission.done, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancel_wait.cancel()
+            if not submission.done.done():
+                # The workers drop what is left of a finished submission.
+                submission.done.cancel()
+            if submission.done.cancelled() or submission.done.exception() is not None:
+                self._remove(submission)
+                for task in list(submission.in_flight):
+                    task.cancel()
+
+        if submission.done.cancelled() or cancelled.is_set() and submission.done.exception() is not None:
+            logging.info("Checks cancelled.")
+            return
+        submission.done.result()
@@ -0,0 +1,100 @@
+# Standard library imports
+import asyncio
+import logging
+from typing import List, Optional
+
+# Third party imports
+from telethon.errors import MultiError
+from telethon.tl.types import InputChannel
+
+# Access hashes are only valid for the account that received them, so
+# resolved channels are stored per account.
+CREATE_CHANNEL_ENTITIES_TABLE = """
+    CREATE TABLE IF NOT EXISTS channel_entities (
+        account TEXT NOT NULL,
+        username TEXT NOT NULL,
+        channel_id INTEGER NOT NULL,
+        access_hash INTEGER NOT NULL,
+        PRIMARY KEY (account, username)
+    )
+"""
+
+
+async def get_input_channel(db, account: str, username: str) -> Optional[InputChannel]:
+    """Returns the stored InputChannel for a username, if it was resolved before."""
+
+    cursor = await db.execute(
+        "SELECT channel_id, access_hash FROM channel_entities WHERE account = ? AND username = ?",
+        (account, username.lower()))
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return None
+    return InputChannel(row[0], row[1])
+
+
+async def save_input_channel(db, account: str, username: str, channel_id: int, access_hash: int):
+    await db.execute('''
+        INSERT OR REPLACE INTO channel_entities(account, username, channel_id, access_hash)
+        VALUES(?, ?, ?, ?)
+    ''', (account, username.lower(), channel_id, access_hash))
+    await db.commit()
+
+
+async def forget_input_channel(db, account: str, username: str):
+    await db.execute("DELETE FROM channel_entities WHERE account = ? AND username = ?",
+                     (account, username.lower()))
+    await db.commit()
+
+
+class RequestBatcher:
+    """Sends requests that arrive while another batch is in flight as one container.
+
+    Only one batch per connection is in flight at a time; requests made in
+    the meantime are grouped into the next one. Each caller still awaits its
+    own result, and an error raised by one request is only delivered to the
+    caller that made it.
+    """
+
+    def __init__(self, client, max_size: int = 10):
+        self.client = client
+        self.max_size = max_size
+        self._pending = []
+        self._flush_task = None
+
+    async def __call__(self, request):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((request, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        return await future
+
+    async def _flush_loop(self):
+        try:
+            # Let requests made in the same loop iteration join the first batch.
+            await asyncio.sleep(0)
+            while self._pending:
+                batch = self._pending[:self.max_size]
+                self._pending = self._pending[self.max_size:]
+                await self._flush(batch)
+        finally:
+            self._flush_task = None
+
+    async def _flush(self, batch):
+        requests = [request for request, _ in batch]
+        try:
+            results: List = await self.client(requests)
+        except MultiError as e:
+            results = [error or result for result, error in zip(e.results, e.exceptions)]
+        except Exception as e:
+            if len(batch) > 1:
+                logging.error(f"Error while sending a batch of {len(batch)} requests: {e}")
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,126 @@
+# Standard library imports
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+from typing import AsyncIterator
+
+# Third party imports
+from aiogram import Bot
+from aiogram.types import InputFile
+
+# Local imports
+from metrics import RPC_LATENCY
+
+EXPORT_TXT = "txt"
+EXPORT_CSV = "csv"
+EXPORT_JSONL = "jsonl"
+EXPORT_FORMATS = (EXPORT_TXT, EXPORT_CSV, EXPORT_JSONL)
+
+CSV_COLUMNS = ("username", "status", "title", "channel_id", "link", "error")
+
+# Reports up to this size stay in memory; larger ones are spooled to disk.
+SPOOL_SIZE = 1024 * 1024
+MESSAGE_LIMIT = 4096
+
+
+def format_txt_row(row: dict) -> str:
+    """Formats a result row as one line that can be uploaded again for a new check."""
+
+    line = row['username']
+    if row.get('title'):
+        line += f" ({row['title']})"
+    if row.get('error'):
+        line += f": {row['error']}"
+    return line
+
+
+class ResultExport:
+    """Writes result rows straight into an upload buffer, gzipped if asked.
+
+    With `sections`, TXT reports get a heading whenever the status of the
+    rows changes, so they should be ordered by status. `columns` are the
+    fields written to CSV.
+    """
+
+    def __init__(self, fmt: str = EXPORT_TXT, compress: bool = False, sections: bool = False,
+                 columns=CSV_COLUMNS):
+        self.fmt = fmt
+        self.columns = columns
+        self.compress = compress
+        self.sections = sections
+        self.rows = 0
+        self.buffer = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        self._raw = gzip.GzipFile(fileobj=self.buffer, mode="wb") if compress else self.buffer
+        self._text = io.TextIOWrapper(self._raw, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._section = None
+        if fmt == EXPORT_CSV:
+            self._csv.writerow(columns)
+
+    def write(self, row: dict):
+        if self.fmt == EXPORT_CSV:
+            self._csv.writerow([row.get(column) for column in self.columns])
+        elif self.fmt == EXPORT_JSONL:
+            self._text.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            if self.sections and row['status'] != self._section:
+                if self.rows:
+                    self._text.write("\n")
+                self._text.write(f"{row['status']}:\n\n")
+                self._section = row['status']
+            self._text.write(format_txt_row(row) + "\n")
+        self.rows += 1
+
+    def finish(self, filename: str) -> InputFile:
+        """Closes the report and returns it ready for upload."""
+
+        self._text.flush()
+        self._text.detach()
+        if self.compress:
+            self._raw.close()
+            filename += ".gz"
+        self.buffer.seek(0)
+        return InputFile(self.buffer, filename=filename)
+
+    def close(self):
+        self.buffer.close()
+
+
+async def send_results(bot: Bot, chat_id: int, rows: AsyncIterator[dict], total: int, caption: str, filename: str,
+                       fmt: str = EXPORT_TXT, inline_limit: int = 50, gzip_threshold: int = 10000,
+                       force_document: bool = False, sections: bool = False, reply_to_message_id: int = None):
+    """Sends small result sets as a message and streams larger ones into a document.
+
+    `total` is the number of rows `rows` will yield. Rows are written to the
+    upload buffer as they arrive, so a report is never built in memory.
+    """
+
+    if total <= inline_limit and not force_document:
+        head = [row async for row in rows]
+        text = caption + "\n\n" + "\n".join(f"- {format_txt_row(row)}" for row in head)
+        if len(text) <= MESSAGE_LIMIT:
+            with RPC_LATENCY.time(method="send_message"):
+                await bot.send_message(chat_id, text, reply_to_message_id=reply_to_message_id)
+            return
+        rows = _replay(head)
+
+    logging.info(f"Exporting {total} rows to {filename}.{fmt}...")
+    export = ResultExport(fmt, compress=total >= gzip_threshold, sections=sections)
+    try:
+        async for row in rows:
+            export.write(row)
+        document = export.finish(f"{filename}.{fmt}")
+        with RPC_LATENCY.time(method="send_document"):
+            await bot.send_document(chat_id, document, caption=caption[:1024],
+                                    reply_to_message_id=reply_to_message_id)
+    finally:
+        export.close()
+    logging.info(f"Finished exporting {export.rows} rows.")
+
+
+async def _replay(rows):
+    for row in rows:
+        yield row
@@ -0,0 +1,70 @@
+# Standard library imports
+import re
+from typing import Iterator, List
+
+# tgstat pages, t.me / telegram.me links and @mentions.
+_MENTIONS = (
+    r"(?:https?://)?(?:www\.)?tgstat\.(?:ru|com)/(?:[a-z]{2}/)?channel/@?(?P<tgstat>\w+)"
+    r"|(?:https?://)?(?:www\.)?(?:t|telegram)\.(?:me|dog)/(?:s/)?@?(?P<link>\w+)"
+    r"|(?<![\w.])@(?P<mention>\w+)")
+MENTION_PATTERN = re.compile(_MENTIONS, re.ASCII | re.IGNORECASE)
+
+# The same plus bare usernames that sit alone on their own line.
+USERNAME_PATTERN = re.compile(
+    _MENTIONS + r"|^[ \t]*(?P<bare>[A-Za-z]\w{3,31})[ \t]*\r?$",
+    re.ASCII | re.IGNORECASE | re.MULTILINE)
+
+BARE_USERNAME = re.compile(r"[ \t]*[A-Za-z]\w{3,31}[ \t]*", re.ASCII)
+
+VALID_USERNAME = re.compile(r"@[a-z][a-z0-9_]{3,30}[a-z0-9]", re.ASCII)
+
+# Paths of t.me links that are not channel usernames.
+RESERVED = frozenset({"joinchat", "addstickers", "addemoji", "share", "proxy", "socks", "login", "c"})
+
+
+def normalize_username(name: str) -> str:
+    """Returns the canonical '@lowercase' form of a username."""
+    return "@" + name.lstrip("@").lower()
+
+
+def is_valid_username(username: str) -> bool:
+    """Checks a normalized username against Telegram's rules (5-32 characters,
+    letters, digits and underscores, starting with a letter)."""
+    return VALID_USERNAME.fullmatch(username) is not None
+
+
+def is_channel_list(text: str) -> bool:
+    """Tells whether a chat message asks for a check: it has an @mention or a
+    link, or it is a list of bare usernames, one per line. A single word
+    such as "thanks" is not one."""
+
+    if MENTION_PATTERN.search(text):
+        return True
+    lines = [line for line in text.splitlines() if line.strip()]
+    return len(lines) > 1 and all(BARE_USERNAME.fullmatch(line) for line in lines)
+
+
+def iter_usernames(text: str, starts_line: bool = True, ends_line: bool = True) -> Iterator[str]:
+    """Yields every normalized username found in the text, including invalid ones.
+
+    When the text does not start (or end) at a line break, its first (or
+    last) line is only part of a line and is not taken as a bare username.
+    """
+
+    # Bare matches before `partial_head` or from `partial_tail` on are skipped.
+    partial_head = 0
+    if not starts_line:
+        partial_head = text.find("\n") if "\n" in text else len(text)
+    partial_tail = len(text) + 1 if ends_line else text.rfind("\n") + 1
+    for match in USERNAME_PATTERN.finditer(text):
+        name = match.group(match.lastindex)
+        if match.lastgroup == "link" and name.lower() in RESERVED:
+            continue
+        if match.lastgroup == "bare" and not partial_head <= match.start() < partial_tail:
+            continue
+        yield normalize_username(name)
+
+
+def extract_usernames(text: str) -> List[str]:
+    """Returns the unique normalized usernames found in the text, in order."""
+    return list(dict.fromkeys(iter_usernames(text)))
@@ -0,0 +1,287 @@
+# Standard library imports
+import time
+from itertools import groupby, zip_longest
+from typing import AsyncIterator, List, Optional
+
+# Local imports
+from cache import STATUS_ERROR
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+# Finished, but the upload could not be read to the end.
+JOB_INCOMPLETE = "incomplete"
+
+TASK_PENDING = "pending"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+
+CREATE_JOBS_TABLE = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        filename TEXT,
+        force_refresh INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 2
+    )
+"""
+
+CREATE_JOB_TASKS_TABLE = """
+    CREATE TABLE IF NOT EXISTS job_tasks (
+        job_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        lease_owner TEXT,
+        lease_until REAL,
+        PRIMARY KEY (job_id, username)
+    )
+"""
+
+# Finds the running jobs by priority without reading the finished ones.
+CREATE_JOBS_STATUS_INDEX = """
+    CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority)
+"""
+
+CREATE_JOB_TASKS_INDEX = """
+    CREATE INDEX IF NOT EXISTS job_tasks_status ON job_tasks (job_id, status)
+"""
+
+# Keeps the tasks of a job in rowid order for paging through the results.
+CREATE_JOB_TASKS_ORDER_INDEX = """
+    CREATE INDEX IF NOT EXISTS job_tasks_job ON job_tasks (job_id)
+"""
+
+
+async def create_job(db, chat_id: int, channels, filename: str = None, force_refresh: bool = False,
+                     priority: int = 2) -> int:
+    """Stores a new job with one pending task per channel and returns its id."""
+
+    cursor = await db.execute('''
+        INSERT INTO jobs(chat_id, filename, force_refresh, status, created_at, priority)
+        VALUES(?, ?, ?, ?, ?, ?)
+    ''', (chat_id, filename, int(force_refresh), JOB_RUNNING, time.time(), priority))
+    job_id = cursor.lastrowid
+    await add_tasks(db, job_id, channels)
+    return job_id
+
+
+async def add_tasks(db, job_id: int, channels):
+    """Adds more pending tasks to an existing job."""
+
+    await db.executemany('''
+        INSERT OR IGNORE INTO job_tasks(job_id, username) VALUES(?, ?)
+    ''', ((job_id, channel) for channel in channels))
+    await db.commit()
+
+
+async def claim_pending(db, job_id: int, limit: int, max_attempts: int) -> List[str]:
+    """Returns the next chunk of pending usernames; the attempt is counted by start_attempt."""
+
+    cursor = await db.execute('''
+        SELECT username FROM job_tasks
+        WHERE job_id = ? AND status = ? AND attempts < ?
+        ORDER BY rowid LIMIT ?
+    ''', (job_id, TASK_PENDING, max_attempts, limit))
+    return [row[0] for row in await cursor.fetchall()]
+
+
+async def start_attempt(db, job_id: int, username: str):
+    """Counts an attempt when the check of a claimed task starts."""
+
+    await db.execute('''
+        UPDATE job_tasks SET attempts = attempts + 1 WHERE job_id = ? AND username = ?
+    ''', (job_id, username))
+    await db.commit()
+
+
+async def lease_tasks(db, owner: str, limit: int, lease_seconds: float, max_attempts: int) -> List[dict]:
+    """Hands up to `limit` pending tasks of running jobs to one worker process and counts the attempt.
+
+    Leased tasks are skipped by other workers until `lease_seconds` have
+    passed, so a worker that dies does not lose them. Tasks are taken by job
+    priority and round-robin over the jobs of the same priority. Only the
+    running jobs and at most `limit` pending rows of each are read, so the
+    finished jobs left in the tables do not slow it down.
+    """
+
+    now = time.time()
+    tasks = []
+    # Locks the database for writing, so two workers never lease the same rows.
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = await db.execute('''
+            SELECT id, chat_id, force_refresh, priority FROM jobs WHERE status = ? ORDER BY priority, id
+        ''', (JOB_RUNNING,))
+        running = await cursor.fetchall()
+        await cursor.close()
+        for _, same_priority in groupby(running, key=lambda job: job[3]):
+            turns = []
+            for job_id, chat_id, force_refresh, priority in same_priority:
+                cursor = await db.execute('''
+                    SELECT rowid, username FROM job_tasks
+                    WHERE job_id = ? AND status = ? AND attempts < ? AND COALESCE(lease_until, 0) < ?
+                    ORDER BY rowid LIMIT ?
+                ''', (job_id, TASK_PENDING, max_attempts, now, limit - len(tasks)))
+                turns.append([(rowid, {"job_id": job_id, "username": username, "chat_id": chat_id,
+                                       "force_refresh": bool(force_refresh), "priority": priority})
+                              for rowid, username in await cursor.fetchall()])
+                await cursor.close()
+            tasks += [task for turn in zip_longest(*turns) for task in turn if task][:limit - len(tasks)]
+            if len(tasks) >= limit:
+                break
+        await db.executemany('''
+            UPDATE job_tasks SET attempts = attempts + 1, lease_owner = ?, lease_until = ? WHERE rowid = ?
+        ''', ((owner, now + lease_seconds, rowid) for rowid, _ in tasks))
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return [task for _, task in tasks]
+
+
+async def release_tasks(db, job_id: int, usernames: List[str]):
+    """Takes back the attempt counted by start_attempt or lease_tasks for tasks that were not checked."""
+
+    await db.executemany('''
+        UPDATE job_tasks SET attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_until = NULL
+        WHERE job_id = ? AND username = ? AND status = ?
+    ''', ((job_id, username, TASK_PENDING) for username in usernames))
+    await db.commit()
+
+
+async def complete_task(db, job_id: int, username: str, result: str, error: str = None):
+    status = TASK_FAILED if error else TASK_DONE
+    await db.execute('''
+        UPDATE job_tasks SET status = ?, result = ?, error = ? WHERE job_id = ? AND username = ?
+    ''', (status, result, error, job_id, username))
+    await db.commit()
+
+
+async def fail_exhausted_tasks(db, job_id: int, max_attempts: int):
+    """Marks tasks that kept failing before they could be finished as failed."""
+
+    await db.execute('''
+        UPDATE job_tasks SET status = ?, error = ?
+        WHERE job_id = ? AND status = ? AND attempts >= ?
+    ''', (TASK_FAILED, "Too many attempts", job_id, TASK_PENDING, max_attempts))
+    await db.commit()
+
+
+async def delete_finished_jobs(db, before: float) -> int:
+    """Deletes the finished jobs created before `before` with their tasks and returns how many there were."""
+
+    cursor = await db.execute("SELECT id FROM jobs WHERE status != ? AND created_at < ?", (JOB_RUNNING, before))
+    job_ids = [row[0] for row in await cursor.fetchall()]
+    # One job per transaction, so the workers are not locked out of the queue for long.
+    for job_id in job_ids:
+        await db.execute("DELETE FROM job_tasks WHERE job_id = ?", (job_id,))
+        await db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        await db.commit()
+    return len(job_ids)
+
+
+async def get_finished_tasks(db, job_id: int) -> List[dict]:
+    cursor = await db.execute('''
+        SELECT username, result, error FROM job_tasks WHERE job_id = ? AND status != ?
+    ''', (job_id, TASK_PENDING))
+    rows = await cursor.fetchall()
+    return [{"username": row[0], "result": row[1], "error": row[2]} for row in rows]
+
+
+async def count_unfinished(db, job_id: int, max_attempts: int) -> int:
+    """Counts the pending tasks of a job that may still be checked: leased ones and those with attempts left."""
+
+    cursor = await db.execute('''
+        SELECT COUNT(*) FROM job_tasks
+        WHERE job_id = ? AND status = ? AND (attempts < ? OR lease_until > ?)
+    ''', (job_id, TASK_PENDING, max_attempts, time.time()))
+    count = (await cursor.fetchone())[0]
+    await cursor.close()
+    return count
+
+
+async def count_tasks(db, job_id: int) -> int:
+    cursor = await db.execute(
+        "SELECT COUNT(*) FROM job_tasks WHERE job_id = ?", (job_id,))
+    return (await cursor.fetchone())[0]
+
+
+async def set_job_status(db, job_id: int, status: str):
+    await db.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+    await db.commit()
+
+
+async def get_running_jobs(db) -> List[dict]:
+    cursor = await db.execute(
+        "SELECT id, chat_id, filename, force_refresh, priority FROM jobs WHERE status = ?", (JOB_RUNNING,))
+    rows = await cursor.fetchall()
+    return [{"id": row[0], "chat_id": row[1], "filename": row[2], "force_refresh": bool(row[3]),
+             "priority": row[4]}
+            for row in rows]
+
+
+async def get_latest_job(db, chat_id: int) -> Optional[dict]:
+    cursor = await db.execute(
+        "SELECT id, filename FROM jobs WHERE chat_id = ? ORDER BY id DESC LIMIT 1", (chat_id,))
+    row = await cursor.fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "filename": row[1]}
+
+
+def _result_condition(result: Optional[str]):
+    if result is None:
+        return "t.status != ?", (TASK_PENDING,)
+    if result == TASK_PENDING:
+        return "t.status = ?", (TASK_PENDING,)
+    if result == STATUS_ERROR:
+        return "t.status != ? AND COALESCE(t.result, ?) = ?", (TASK_PENDING, STATUS_ERROR, STATUS_ERROR)
+    return "t.result = ?", (result,)
+
+
+async def count_results(db, job_id: int, result: str = None) -> int:
+    """Counts the finished tasks of a job, or only those with the given result
+    (a channel status, or TASK_PENDING for the unchecked ones)."""
+
+    condition, params = _result_condition(result)
+    cursor = await db.execute(
+        f"SELECT COUNT(*) FROM job_tasks t WHERE t.job_id = ? AND {condition}", (job_id, *params))
+    count = (await cursor.fetchone())[0]
+    await cursor.close()
+    return count
+
+
+async def iter_job_results(db, job_id: int, result: str = None, page_size: int = 1000) -> AsyncIterator[dict]:
+    """Yields the tasks of a job with their cached channel info, page by page.
+
+    Takes the same `result` filter as count_results.
+    """
+
+    condition, params = _result_condition(result)
+    last_rowid = 0
+    while True:
+        cursor = await db.execute(f'''
+            SELECT t.rowid, t.username, t.status, t.result, t.error, s.title, s.channel_id
+            FROM job_tasks t LEFT JOIN channel_status s ON s.username = t.username
+            WHERE t.job_id = ? AND t.rowid > ? AND {condition}
+            ORDER BY t.rowid LIMIT ?
+        ''', (job_id, last_rowid, *params, page_size))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        for row in rows:
+            yield {
+                "username": row[1],
+                "status": TASK_PENDING if row[2] == TASK_PENDING else row[3] or STATUS_ERROR,
+                "title": row[5],
+                "channel_id": row[6],
+                "link": f"https://t.me/{row[1].lstrip('@')}",
+                "error": row[4],
+            }
+        if len(rows) < page_size:
+            return
+        last_rowid = rows[-1][0]
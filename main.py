@@ -1,48 +1,138 @@
 # Local import
-from utilities import *
+from utilities import BANNER, add_user, format_user, generate_keyboard, generate_progress_message
+from engine import (PRIORITY_ADMIN, PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_WATCH, CheckEngine, RetryLater,
+                    RetryPolicy)
+from clients import ClientPool, load_bot_tokens
+from progress import ProgressReporter
+from parsing import CHUNK_SIZE, detect_format, parse_channel_stream
+from database import DATABASE, ensure_columns, get_db, open_connection
+from sessions import SessionStore
+from entities import CREATE_CHANNEL_ENTITIES_TABLE, forget_input_channel, get_input_channel, save_input_channel
+from extractor import extract_usernames, is_channel_list, is_valid_username
+from jobs import (CREATE_JOB_TASKS_INDEX, CREATE_JOB_TASKS_ORDER_INDEX, CREATE_JOB_TASKS_TABLE,
+                  CREATE_JOBS_STATUS_INDEX, CREATE_JOBS_TABLE, JOB_CANCELLED, JOB_DONE, JOB_INCOMPLETE, TASK_PENDING, claim_pending,
+                  complete_task, count_results, count_tasks, delete_finished_jobs, fail_exhausted_tasks,
+                  get_finished_tasks,
+                  get_latest_job, get_running_jobs, iter_job_results, release_tasks, set_job_status,
+                  start_attempt)
+from cache import (CREATE_CHANNEL_STATUS_TABLE, STATUS_CLOSED, STATUS_ERROR, STATUS_OPEN,
+                   get_cached_status, save_status)
+from records import ChannelResult, error_reason, exception_reason
+from taskqueue import SQLiteTaskQueue
+from quotas import USER_QUOTA_COLUMNS, consume_quota
+from users import (CREATE_USERS_INDEXES, CREATE_USERS_TABLE, USER_COLUMNS, USER_FIELDS, add_checks, count_users,
+                   get_top_users, get_user_by_token, get_users_page, iter_users, search_users, set_api_token)
+from watch import (CREATE_WATCHED_CHANNELS_INDEX, CREATE_WATCHED_CHANNELS_TABLE, count_watched, get_due_channels,
+                   unwatch_channels, update_watched, watch_channels)
+from export import EXPORT_CSV, EXPORT_FORMATS, EXPORT_TXT, ResultExport, send_results
+from metrics import (CACHE_LOOKUPS, CHANNELS_CHECKED, DB_WRITE_LATENCY, FLOOD_WAIT_SECONDS, FLOOD_WAITS, JOB_THROUGHPUT,
+                     RPC_LATENCY, Gauge, start_metrics_server)
+from api import hash_token, start_api_server
 
 # Standard library imports
 import asyncio
 import logging
+import math
 import os
-import re
+import secrets
 import signal
-import sys
-import tempfile
+import socket
 import time
-from contextlib import asynccontextmanager
-from typing import List
+from typing import AsyncIterator, Awaitable, Callable, List, Sequence
 
 # Third party imports
-import aiosqlite
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher.middlewares import BaseMiddleware
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
 from aiogram.utils.exceptions import NetworkError
 from dotenv import load_dotenv
-from telethon import TelegramClient
-from telethon.errors import FloodWaitError, ChannelInvalidError
-from telethon.errors.rpcerrorlist import FloodWaitError, UsernameNotOccupiedError, UsernameInvalidError
+from telethon.errors import ServerError, TimedOutError
+from telethon.errors.rpcerrorlist import (ChannelInvalidError, ChannelPrivateError, FloodWaitError,
+                                          UsernameInvalidError, UsernameNotOccupiedError)
 from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.types import Channel
 from tqdm import tqdm
 
-load_dotenv()
+# Only running the bot reads .env; importing this module (from tests,
+# benchmarks or other tools) has no side effects.
+if __name__ == '__main__':
+    load_dotenv()
 
 
 API_ID = os.getenv("TELEGRAM_API_ID")
 API_HASH = os.getenv("TELEGRAM_API_HASH")
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN12")
 USER_ID = os.environ.get("TELEGRAM_USER_ID")
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", 20))
 DB_NAME = os.environ.get("DB_NAME")
-
-BOT = Bot(BOT_TOKEN)
-DP = Dispatcher(BOT)
+GET_ENTITY_RATE = float(os.environ.get("GET_ENTITY_RATE", 1))
+GET_ENTITY_BURST = int(os.environ.get("GET_ENTITY_BURST", 5))
+FULL_CHANNEL_RATE = float(os.environ.get("FULL_CHANNEL_RATE", 1))
+FULL_CHANNEL_BURST = int(os.environ.get("FULL_CHANNEL_BURST", 5))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 6 * 60 * 60))
+ERROR_CACHE_TTL = float(os.environ.get("ERROR_CACHE_TTL", 24 * 60 * 60))
+CLIENT_HEALTH_INTERVAL = float(os.environ.get("CLIENT_HEALTH_INTERVAL", 60))
+BOT_TOKENS = load_bot_tokens() or [BOT_TOKEN]
+JOB_CHUNK_SIZE = int(os.environ.get("JOB_CHUNK_SIZE", 500))
+MAX_TASK_ATTEMPTS = int(os.environ.get("MAX_TASK_ATTEMPTS", 3))
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", 7 * 24 * 60 * 60))
+JOB_CLEANUP_INTERVAL = float(os.environ.get("JOB_CLEANUP_INTERVAL", 60 * 60))
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 5))
+PROGRESS_STEP = int(os.environ.get("PROGRESS_STEP", 10))
+CHECK_WORKERS = int(os.environ.get("CHECK_WORKERS") or 0) or 2 * len(BOT_TOKENS)
+SESSION_LIMIT = int(os.environ.get("SESSION_LIMIT", 1000))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 24 * 60 * 60))
+DAILY_QUOTA = int(os.environ.get("DAILY_QUOTA", 5000))
+EXPORT_INLINE_LIMIT = int(os.environ.get("EXPORT_INLINE_LIMIT", 50))
+EXPORT_GZIP_THRESHOLD = int(os.environ.get("EXPORT_GZIP_THRESHOLD", 10000))
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 2))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 300))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 8000))
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 10))
+WATCH_INTERVAL = float(os.environ.get("WATCH_INTERVAL", 24 * 60 * 60))
+WATCH_TICK = float(os.environ.get("WATCH_TICK", 60))
+WATCH_LIMIT = int(os.environ.get("WATCH_LIMIT", 1000))
+ROLE_ALL = "all"
+ROLE_FRONT = "front"
+ROLE_WORKER = "worker"
+ROLE = os.environ.get("ROLE", ROLE_ALL).lower()
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_BATCH = int(os.environ.get("LEASE_BATCH", 50))
+LEASE_SECONDS = float(os.environ.get("LEASE_SECONDS", 600))
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", 1))
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", 0))
+API_CHUNK_SIZE = int(os.environ.get("API_CHUNK_SIZE", 100))
+
+# Created by create_app().
+BOT = None
+DP = None
+CLIENT_POOL = None
 SESSION_NAME = "anon"
-CHECKED_CHANNELS, CANCELATION_FLAG = {}, {}
-REQUEST_COUNT = 0
-FILENAME = None
+SESSIONS = SessionStore(SESSION_LIMIT, SESSION_IDLE_TIMEOUT)
+ENGINE = CheckEngine(CHECK_WORKERS)
+RETRY_POLICY = RetryPolicy(RETRY_ATTEMPTS, RETRY_BACKOFF, RETRY_BACKOFF_MAX)
+# Errors worth trying again later instead of reporting them right away.
+TRANSIENT_ERRORS = (ServerError, TimedOutError, ConnectionError, asyncio.TimeoutError)
+METRICS_SERVER = None
+WATCH_TASK = None
+CLEANUP_TASK = None
+TASK_QUEUE = None
+API_SERVER = None
+# Set on shutdown; running jobs stop and stay in the queue to be resumed.
+SHUTTING_DOWN = asyncio.Event()
+
+Gauge("bot_queue_depth", "Channels waiting for a check worker.", lambda: ENGINE.queue_depth)
+Gauge("bot_check_workers", "Number of check workers.", lambda: ENGINE.workers)
 
 
 class UserTrackingMiddleware(BaseMiddleware):
@@ -50,417 +140,1123 @@ class UserTrackingMiddleware(BaseMiddleware):
         await add_user(message.from_user)
 
 
-DP.middleware.setup(UserTrackingMiddleware())
-DP.middleware.setup(LoggingMiddleware())
+async def send_summary(chat_id: int, opened_comments: List[str], closed_comments: List[str], errors: List[str]):
+    logging.info("Sending summary...")
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("Opened", callback_data="opened"), InlineKeyboardButton(
+        "Closed", callback_data="closed"), InlineKeyboardButton("Errors", callback_data="errors"))
+    keyboard.add(InlineKeyboardButton("📄 View checked", callback_data="view_checked"),
+                 InlineKeyboardButton("📄 Unchecked Channels", callback_data="unchecked"))
+    await BOT.send_message(
+        chat_id=chat_id,
+        text=f"*Summary:*\n\n*Opened:* {len(opened_comments)}\n*Closed:* {len(closed_comments)}\n*Errors:* {len(errors)}",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+    logging.info("Finished sending summary.")
 
 
-if not USER_ID:
-    USER_ID = input(
-        "TELEGRAM_USER_ID is unset in '.env'. Please enter TELEGRAM_USER_ID: ")
+CHECKED_RESULTS = (STATUS_OPEN, STATUS_CLOSED, STATUS_ERROR)
+EXPORT_RESULTS = {
+    "opened": (STATUS_OPEN,),
+    "closed": (STATUS_CLOSED,),
+    "errors": (STATUS_ERROR,),
+    "unchecked": (TASK_PENDING,),
+    "all": CHECKED_RESULTS,
+}
 
 
-@asynccontextmanager
-async def get_telethon_client():
-    global CANCELATION_FLAG
-    logging.info("Getting Telethon client...")
-    session_file_path = f"{SESSION_NAME}.session"
-    telethon_client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
-    try:
-        await telethon_client.start(bot_token=BOT_TOKEN)
-    except FloodWaitError as e:
-        logging.error(f"{e.message}:Waiting for {e.seconds}.")
+async def send_job_results(chat_id: int, job_id: int, results: Sequence[str], caption: str, filename: str,
+                           fmt: str = EXPORT_TXT, force_document: bool = False, empty_text: str = None,
+                           reply_to_message_id: int = None):
+    """Streams the tasks of a job with the given results to the chat, grouped by result."""
 
-        raise e
+    logging.info("Sending job results...")
+    async with get_db() as db:
+        total = 0
+        for result in results:
+            total += await count_results(db, job_id, result)
+        if not total:
+            await BOT.send_message(chat_id, empty_text or "Nothing to send.", reply_to_message_id=reply_to_message_id)
+            return
 
-    def signal_handler(sig, frame):
+        async def rows():
+            for result in results:
+                async for row in iter_job_results(db, job_id, result):
+                    yield row
 
-        if os.path.exists(session_file_path):
-            os.remove(session_file_path)
-        sys.exit(0)
+        await send_results(BOT, chat_id, rows(), total, caption, filename, fmt, EXPORT_INLINE_LIMIT,
+                           EXPORT_GZIP_THRESHOLD, force_document, len(results) > 1, reply_to_message_id)
+    logging.info("Finished sending job results.")
 
-    signal.signal(signal.SIGINT, signal_handler)
 
-    try:
-        yield telethon_client
-    except FloodWaitError as e:
-        logging.error(f"{e.message}:Waiting for {e.seconds}.")
-        raise e
-    finally:
-        await telethon_client.disconnect()
-        if os.path.exists(session_file_path):
-            os.remove(session_file_path)
-        logging.info("Finished getting Telethon client.")
+def job_file_stem(job: dict, default: str) -> str:
+    return os.path.splitext(job['filename'])[0] if job['filename'] else default
 
 
-@asynccontextmanager
-async def get_db():
-    db = await aiosqlite.connect(DB_NAME)
-    try:
-        yield db
-    finally:
-        await db.close()
+def job_priority(message: types.Message, interactive: bool) -> int:
+    if str(message.from_user.id) == USER_ID:
+        return PRIORITY_ADMIN
+    return PRIORITY_INTERACTIVE if interactive else PRIORITY_BULK
 
-db_lock = asyncio.Lock()
 
+async def grant_quota(user_id: int, count: int) -> int:
+    """Takes up to `count` checks from the user's daily quota and counts them as the user's checks.
 
-def generate_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("View checked", callback_data="view_checked"),
-                 InlineKeyboardButton("Cancel", callback_data="cancel"))
-    return keyboard
+    Returns how many were granted; the admin is not limited.
+    """
 
+    await DATABASE.flush_users()
+    async with get_db() as db:
+        if str(user_id) == USER_ID:
+            granted = count
+        else:
+            granted = await consume_quota(db, user_id, count, DAILY_QUOTA)
+        await add_checks(db, user_id, granted)
+    return granted
 
-async def send_summary(chat_id: int, opened_comments: List[str], closed_comments: List[str], errors: List[str]):
-    logging.info("Sending summary...")
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Opened", callback_data="opened"), InlineKeyboardButton(
-        "Closed", callback_data="closed"), InlineKeyboardButton("Errors", callback_data="errors"))
-    keyboard.add(InlineKeyboardButton("📄 View checked", callback_data="view_checked"),
-                 InlineKeyboardButton("📄 Unchecked Channels", callback_data="unchecked"))
-    await BOT.send_message(
-        chat_id=chat_id,
-        text=f"*Summary:*\n\n*Opened:* {len(opened_comments)}\n*Closed:* {len(closed_comments)}\n*Errors:* {len(errors)}",
-        reply_markup=keyboard,
-        parse_mode='Markdown'
-    )
-    logging.info("Finished sending summary.")
 
+async def apply_quota(message: types.Message, channels: List[str]) -> List[str]:
+    """Cuts the channels down to what is left of the user's daily quota and counts them as the user's checks."""
+
+    granted = await grant_quota(message.from_user.id, len(channels))
+    if granted < len(channels):
+        logging.info(f"User {message.from_user.id} is over the daily quota, {len(channels) - granted} channels skipped.")
+        await message.reply(f"Daily quota reached: {len(channels) - granted} channels were skipped. "
+                            "Please try again tomorrow.")
+    return channels[:granted]
+
+
+async def record_status(channel_username: str, status: str, **fields):
+    async with get_db() as db:
+        with DB_WRITE_LATENCY.time(operation="save_status"):
+            await save_status(db, channel_username, status, **fields)
+
+
+async def iter_document_chunks(document: types.Document) -> AsyncIterator[bytes]:
+    """Downloads an uploaded document piece by piece."""
+
+    file = await BOT.get_file(document.file_id)
+    session = await BOT.get_session()
+    async with session.get(BOT.get_file_url(file.file_path)) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            yield chunk
 
-async def send_channels_file(chat_id: int, channels: List[dict], filename: str):
-    logging.info("Sending channels file...")
-    with tempfile.NamedTemporaryFile(mode="w+t", delete=False) as f:
-        for channel in channels:
-            if type(channel['username']) != int:
-                logging.warning(f"Invalid username: {channel['username']}")
-                continue
-            f.write(
-                f"{channel['title']} ({channel['username']}): {channel['link']}\n")
-        f.seek(0)
-        await BOT.send_document(chat_id=chat_id, document=InputFile(f), caption=filename)
-    os.unlink(f.name)
 
-    logging.info("Finished sending files.")
+async def fetch_known_channel(account, channel_username: str):
+    """Gets the full info of a channel this account resolved before, skipping get_entity.
 
+    Returns the full channel and the channel itself, or None when the channel
+    is unknown or the stored entity is no longer valid for this username.
+    """
 
-async def handle_channel_processing(channel_username: str, telethon_client, opened_comments: dict, closed_comments: dict, errors: dict):
-    global REQUEST_COUNT, CANCELATION_FLAG
-    sleep_time = None
+    async with get_db() as db:
+        input_channel = await get_input_channel(db, account.name, channel_username)
+    if input_channel is None:
+        return None
+
+    await account.full_channel_limiter.acquire()
+    try:
+        with RPC_LATENCY.time(method="GetFullChannelRequest"):
+            full_channel = await account.batcher(GetFullChannelRequest(input_channel))
+        account.requests += 1
+    except (ChannelInvalidError, ChannelPrivateError) as e:
+        logging.info(f"Stored entity for {channel_username} is no longer valid: {e}")
+        full_channel = None
+
+    channel = full_channel and next(
+        (chat for chat in full_channel.chats if chat.id == input_channel.channel_id), None)
+    if channel is None or (channel.username or "").lower() != channel_username[1:].lower():
+        async with get_db() as db:
+            await forget_input_channel(db, account.name, channel_username)
+        return None
+    return full_channel, channel
+
+
+async def handle_channel_processing(channel_username: str, account, opened_comments: dict, closed_comments: dict, errors: dict, force_refresh: bool = False):
+    if not force_refresh:
+        async with get_db() as db:
+            cached = await get_cached_status(db, channel_username, CACHE_TTL, ERROR_CACHE_TTL)
+        CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+        if cached:
+            if cached['status'] == STATUS_OPEN:
+                opened_comments[channel_username] = ChannelResult.from_row(cached)
+            elif cached['status'] == STATUS_CLOSED:
+                closed_comments[channel_username] = ChannelResult.from_row(cached)
+            else:
+                errors[channel_username] = error_reason(cached['error'] or "Unknown error")
+            return
+
+    account.checks += 1
+    limiter = account.full_channel_limiter
     try:
-        channel = await telethon_client.get_entity(channel_username)
-        REQUEST_COUNT += 1
-        if REQUEST_COUNT % 1 == 0:
-            sleep_time = 4
-            time.sleep(sleep_time)
-        full_channel = await telethon_client(GetFullChannelRequest(channel))
-        if full_channel.full_chat.linked_chat_id:
-            opened_comments[channel_username] = channel
+        channel = await fetch_known_channel(account, channel_username)
+        if channel:
+            full_channel, channel = channel
+        else:
+            limiter = account.get_entity_limiter
+            await limiter.acquire()
+            with RPC_LATENCY.time(method="get_entity"):
+                channel = await account.client.get_entity(channel_username)
+            account.requests += 1
+            if isinstance(channel, Channel):
+                async with get_db() as db:
+                    with DB_WRITE_LATENCY.time(operation="save_entity"):
+                        await save_input_channel(db, account.name, channel_username, channel.id, channel.access_hash)
+            limiter = account.full_channel_limiter
+            await limiter.acquire()
+            with RPC_LATENCY.time(method="GetFullChannelRequest"):
+                full_channel = await account.batcher(GetFullChannelRequest(channel))
+            account.requests += 1
+        linked_chat_id = full_channel.full_chat.linked_chat_id
+        status = STATUS_OPEN if linked_chat_id else STATUS_CLOSED
+        # Only a compact record is kept, not the Telethon entity.
+        result = ChannelResult(channel_username, channel.id, channel.title, status)
+        if linked_chat_id:
+            opened_comments[channel_username] = result
         else:
-            closed_comments[channel_username] = channel
+            closed_comments[channel_username] = result
+        await record_status(channel_username, status, channel_id=channel.id, title=channel.title,
+                            linked_chat_id=linked_chat_id)
 
     except UsernameNotOccupiedError:
         logging.warning("Username %s not occupied", channel_username)
-        errors[channel_username] = "Username not occupied"
+        errors[channel_username] = error_reason("Username not occupied")
+        await record_status(channel_username, STATUS_ERROR, error=errors[channel_username])
     except UsernameInvalidError:
         logging.warning("Invalid username: %s", channel_username)
-        errors[channel_username] = "Invalid username"
+        errors[channel_username] = error_reason("Invalid username")
+        await record_status(channel_username, STATUS_ERROR, error=errors[channel_username])
     except ValueError as e:
         logging.warning("ValueError while processing %s: %s",
                         channel_username, e)
-        errors[channel_username] = f"Error while processing {channel_username}: {e}"
+        errors[channel_username] = exception_reason(e)
+        await record_status(channel_username, STATUS_ERROR, error=errors[channel_username])
     except FloodWaitError as e:
-        logging.error(f"{e.message}:Waiting for {e.seconds}.")
-        CANCELATION_FLAG = True
-        time.sleep(e.seconds)
+        logging.error(f"{e.message}:Pausing client {account.name} for {e.seconds}.")
+        FLOOD_WAITS.inc(account=account.name)
+        FLOOD_WAIT_SECONDS.inc(e.seconds, account=account.name)
+        limiter.pause(e.seconds)
+        account.suspend(e.seconds)
         raise e
+    except TRANSIENT_ERRORS as e:
+        logging.warning(f"Transient error while processing {channel_username}: {e!r}")
+        raise
     except Exception as e:
         logging.error("Error while processing %s: %s", channel_username, e)
-        errors[channel_username] = f"Error while processing {channel_username}: {e}"
+        errors[channel_username] = exception_reason(e)
 
 
-async def update_checked_channels(chat_id, channel_username, opened_comments, closed_comments, errors):
-    if channel_username in opened_comments:
-        CHECKED_CHANNELS[chat_id]['opened_comments'].append(channel_username)
-    elif channel_username in closed_comments:
-        CHECKED_CHANNELS[chat_id]['closed_comments'].append(channel_username)
-    elif channel_username in errors:
-        CHECKED_CHANNELS[chat_id]['errors'].append(channel_username)
+async def check_channels(channels: List[str], message: types.Message, force_refresh: bool = False, filename: str = None,
+                         priority: int = PRIORITY_BULK):
+    """Checks the channels as a new job; returns the job id and the results of run_job."""
 
+    job_id = await TASK_QUEUE.create_job(message.chat.id, channels, filename, force_refresh, priority)
+    progress_message = await message.reply("Starting to check channels...")
+    return job_id, await run_job(job_id, message.chat.id, progress_message, force_refresh, priority=priority)
 
-def save_unchecked_channels(channels):
-    with open(FILENAME or "channels.txt", 'w') as f:
-        for channel in channels:
-            f.write(channel + '\n')
 
+async def check_channel_stream(batches: AsyncIterator[List[str]], message: types.Message, force_refresh: bool = False,
+                               filename: str = None, priority: int = PRIORITY_BULK):
+    """Checks channels while the rest of them are still being read from an upload.
 
-async def check_channels(telethon_client, channels: List[str], message: types.Message):
-    global FILENAME
-    opened_comments, closed_comments, errors = {}, {}, {}
+    Returns the job id and the results of run_job, like check_channels. When
+    the upload cannot be read to the end, the user is told so, the job is
+    marked incomplete and the results are None, so no summary is sent as if
+    the whole file was checked.
+    """
+
+    job_id = await TASK_QUEUE.create_job(message.chat.id, [], filename, force_refresh, priority)
     progress_message = await message.reply("Starting to check channels...")
-    start_time = time.time()
-    CHECKED_CHANNELS[message.chat.id] = {
-        'opened_comments': [],
-        'closed_comments': [],
-        'errors': []
-    }
-
-    if len(channels) > 200:
-        channels_to_check = list(channels)[:200]
-    else:
-        channels_to_check = list(channels)
-    total = len(channels_to_check)
-    logging.info(f"Checking {total} channels...")
-    for i, channel_username in tqdm(enumerate(channels_to_check), total=total):
-        if CANCELATION_FLAG.get(message.chat.id):
-            logging.info("Canceled by user. Stopping checking channels.")
-            CANCELATION_FLAG[message.chat.id] = False
-            save_unchecked_channels(channels)
-            return opened_comments, closed_comments, errors
-        if re.match(r"@[\w\d]+", channel_username):
-            await handle_channel_processing(channel_username, telethon_client, opened_comments, closed_comments, errors)
+    tasks_added = asyncio.Event()
+    read_error = None
+
+    async def feed():
+        nonlocal read_error
+        try:
+            async for channels in batches:
+                granted = await apply_quota(message, channels)
+                with DB_WRITE_LATENCY.time(operation="add_tasks"):
+                    await TASK_QUEUE.enqueue(job_id, granted)
+                tasks_added.set()
+                if len(granted) < len(channels):
+                    break
+        except Exception as e:
+            logging.error(f"Error while reading channels for job {job_id}: {e}")
+            read_error = e
+        finally:
+            tasks_added.set()
+
+    feeder = asyncio.create_task(feed())
+    try:
+        results = await run_job(job_id, message.chat.id, progress_message, force_refresh, feeder, tasks_added, priority)
+    finally:
+        feeder.cancel()
+    if read_error is None or SHUTTING_DOWN.is_set():
+        return job_id, results
+    async with get_db() as db:
+        await set_job_status(db, job_id, JOB_INCOMPLETE)
+        checked = await count_results(db, job_id)
+    await message.reply(f"The file could not be read to the end ({read_error}). Only the {checked} channels read "
+                        "before the error were checked; send /export to get them.")
+    return job_id, None
+
+
+async def run_job(job_id: int, chat_id: int, progress_message: types.Message, force_refresh: bool = False,
+                  feeder: asyncio.Task = None, tasks_added: asyncio.Event = None, priority: int = PRIORITY_BULK):
+    """Checks the pending tasks of a job chunk by chunk until none are left.
+
+    While `feeder` is still running, more tasks may be added to the job;
+    `tasks_added` is set whenever that happens. The checks share the engine
+    with the jobs of other chats and are scheduled by `priority`.
+
+    Returns None when the bot shuts down before the job is finished (the job
+    keeps its unchecked channels and is resumed on the next start) or when
+    the job has no channels at all.
+    """
+
+    session = SESSIONS.get(chat_id)
+    cancelled = session.start_job(job_id)
+
+    def on_shutdown(future: asyncio.Future):
+        if not future.cancelled():
+            cancelled.set()
+
+    # A shutdown stops the job the same way a cancel does.
+    shutdown = asyncio.ensure_future(SHUTTING_DOWN.wait())
+    shutdown.add_done_callback(on_shutdown)
+    try:
+        return await _run_job(job_id, session, cancelled, progress_message, force_refresh, feeder, tasks_added, priority)
+    finally:
+        shutdown.cancel()
+        session.finish_job(job_id)
+
+
+async def load_results(db, job_id: int):
+    """Reads the finished tasks of a job back into opened, closed and error dicts."""
+
+    opened_comments, closed_comments, errors = {}, {}, {}
+    for task in await get_finished_tasks(db, job_id):
+        if task['result'] == STATUS_OPEN:
+            opened_comments[task['username']] = ChannelResult.from_row(task)
+        elif task['result'] == STATUS_CLOSED:
+            closed_comments[task['username']] = ChannelResult.from_row(task)
         else:
-            logging.warning(f"Invalid username: {channel_username}")
-            errors[channel_username] = "Invalid username"
-        elapsed_time = time.time() - start_time
+            errors[task['username']] = error_reason(task['error'] or "Unknown error")
+    return opened_comments, closed_comments, errors
+
+
+async def check_channel(channel_username: str, opened_comments: dict, closed_comments: dict, errors: dict,
+                        force_refresh: bool, retries: dict):
+    """Checks one channel of a job with the account that has the most budget left.
+
+    Transient errors are retried later through the engine until
+    RETRY_POLICY runs out of attempts (counted in `retries`).
+    """
 
-        progress_message_text = generate_progress_message(i, total, elapsed_time)
-        keyboard = generate_keyboard()
-        await progress_message.edit_text(
-            generate_progress_message(i + 1, total, elapsed_time),
-            reply_markup=keyboard
-        )
-        await update_checked_channels(message.chat.id, channel_username, opened_comments, closed_comments, errors)
+    if not is_valid_username(channel_username):
+        logging.warning(f"Invalid username: {channel_username}")
+        errors[channel_username] = error_reason("Invalid username")
+        return
+    try:
+        async with CLIENT_POOL.lease() as account:
+            await handle_channel_processing(channel_username, account, opened_comments, closed_comments, errors, force_refresh)
+    except TRANSIENT_ERRORS as e:
+        attempt = retries[channel_username] = retries.get(channel_username, 0) + 1
+        if attempt < RETRY_POLICY.attempts:
+            raise RetryLater(RETRY_POLICY.delay(attempt))
+        logging.warning(f"Giving up on {channel_username} after {attempt} attempts: {e!r}")
+        errors[channel_username] = exception_reason(e)
+
+
+def task_result(channel_username: str, opened_comments: dict, closed_comments: dict, errors: dict):
+    """Returns the result and error to store for a checked channel."""
 
-        channels.remove(channel_username)
+    if channel_username in opened_comments:
+        return STATUS_OPEN, None
+    if channel_username in closed_comments:
+        return STATUS_CLOSED, None
+    return STATUS_ERROR, errors.get(channel_username) or "Unknown error"
+
+
+async def _run_job(job_id: int, session, cancelled: asyncio.Event, progress_message: types.Message,
+                   force_refresh: bool, feeder: asyncio.Task, tasks_added: asyncio.Event, priority: int):
+    async with get_db() as db:
+        opened_comments, closed_comments, errors = await load_results(db, job_id)
+        total = await count_tasks(db, job_id)
+        checked = len(opened_comments) + len(closed_comments) + len(errors)
+        progress_bar = tqdm(total=total, initial=checked)
+        reporter = ProgressReporter(progress_message, total, generate_progress_message, generate_keyboard(job_id),
+                                    checked, interval=PROGRESS_INTERVAL, step=PROGRESS_STEP)
+
+        retries = {}
+        started = set()
+
+        def show_pause():
+            resume_at = CLIENT_POOL.resume_time()
+            if resume_at:
+                reporter.pause(resume_at)
+
+        async def check(channel_username):
+            if channel_username not in started:
+                started.add(channel_username)
+                with DB_WRITE_LATENCY.time(operation="start_attempt"):
+                    await start_attempt(db, job_id, channel_username)
+            show_pause()
+            try:
+                await check_channel(channel_username, opened_comments, closed_comments, errors, force_refresh, retries)
+            except FloodWaitError:
+                show_pause()
+                raise
+
+        async def on_checked(channel_username):
+            result, error = task_result(channel_username, opened_comments, closed_comments, errors)
+            with DB_WRITE_LATENCY.time(operation="complete_task"):
+                await complete_task(db, job_id, channel_username, result, error)
+            CHANNELS_CHECKED.inc(result=result)
+            progress_bar.update(1)
+            reporter.advance()
+
+        async def follow_workers():
+            # The worker processes check the tasks; only their progress is shown here.
+            while not cancelled.is_set():
+                feeding = feeder is not None and not feeder.done()
+                reporter.total, finished = await TASK_QUEUE.progress(job_id)
+                progress_bar.total = reporter.total
+                progress_bar.update(finished - progress_bar.n)
+                reporter.advance(finished - reporter.checked)
+                if not feeding and not await TASK_QUEUE.unfinished(job_id):
+                    break
+                try:
+                    await asyncio.wait_for(cancelled.wait(), QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+        logging.info(f"Checking {total - checked} of {total} channels for job {job_id}...")
+        reporter.start()
+        try:
+            if ROLE == ROLE_FRONT:
+                await follow_workers()
+            else:
+                while not cancelled.is_set():
+                    feeding = feeder is not None and not feeder.done()
+                    chunk = await claim_pending(db, job_id, JOB_CHUNK_SIZE, MAX_TASK_ATTEMPTS)
+                    if chunk:
+                        reporter.total = progress_bar.total = await count_tasks(db, job_id)
+                        await ENGINE.run(chunk, check, on_checked, cancelled, session.chat_id, priority)
+                    elif feeding:
+                        waiters = {asyncio.ensure_future(tasks_added.wait()), asyncio.ensure_future(cancelled.wait())}
+                        _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                        for waiter in pending:
+                            waiter.cancel()
+                        tasks_added.clear()
+                    else:
+                        break
+        finally:
+            await reporter.close()
+            progress_bar.close()
+
+        if cancelled.is_set() and SHUTTING_DOWN.is_set():
+            # Checks cut short by the shutdown do not count as attempts.
+            await release_tasks(db, job_id, list(started))
+            logging.info(f"Job {job_id} left in the queue until the next start.")
+            await progress_message.edit_text("The bot is restarting. The check will continue after the restart.")
+            return None
+
+        if ROLE == ROLE_FRONT:
+            opened_comments, closed_comments, errors = await load_results(db, job_id)
+
+        if cancelled.is_set():
+            logging.info("Canceled by user. Stopping checking channels.")
+            await set_job_status(db, job_id, JOB_CANCELLED)
+            return opened_comments, closed_comments, errors
 
-    save_unchecked_channels(channels)
+        await fail_exhausted_tasks(db, job_id, MAX_TASK_ATTEMPTS)
+        await set_job_status(db, job_id, JOB_DONE)
+        if not reporter.total:
+            # Nothing was read from the upload or everything was over the quota.
+            await progress_message.edit_text("No channels to check.")
+            return None
+        elapsed = time.time() - reporter.start_time
+        if reporter.checked > checked and elapsed > 0:
+            JOB_THROUGHPUT.observe((reporter.checked - checked) / elapsed)
 
     logging.info("Finished checking channels.")
     return opened_comments, closed_comments, errors
 
 
+async def publish_results(chat_id: int, opened_comments: dict, closed_comments: dict, errors: dict):
+    await send_summary(chat_id, opened_comments, closed_comments, errors)
+
+
+async def resume_job(job: dict):
+    """Continues a job that was interrupted by a restart."""
+
+    chat_id = job['chat_id']
+    logging.info(f"Resuming job {job['id']} for chat {chat_id}...")
+    try:
+        progress_message = await BOT.send_message(chat_id, "Resuming the interrupted check...")
+        results = await run_job(job['id'], chat_id, progress_message, job['force_refresh'], priority=job['priority'])
+        if results is not None:
+            await publish_results(chat_id, *results)
+    except Exception as e:
+        logging.error(f"Error while resuming job {job['id']}: {e}")
+
+
+def format_changes(opened: List[str], closed: List[str]) -> str:
+    lines = ["Watched channels changed:"]
+    for title, usernames in (("Comments opened", opened), ("Comments closed", closed)):
+        if usernames:
+            lines += ["", f"{title}:"] + usernames[:EXPORT_INLINE_LIMIT]
+            if len(usernames) > EXPORT_INLINE_LIMIT:
+                lines.append(f"...and {len(usernames) - EXPORT_INLINE_LIMIT} more")
+    return "\n".join(lines)
+
+
+async def check_watched(usernames: List[str]):
+    """Re-checks watched channels and sends every watching chat the channels whose comments opened or closed."""
+
+    statuses = {}
+    changes = {}
+
+    async def check(channel_username):
+        opened_comments, closed_comments, errors = {}, {}, {}
+        try:
+            async with CLIENT_POOL.lease() as account:
+                await handle_channel_processing(channel_username, account, opened_comments, closed_comments, errors)
+        except TRANSIENT_ERRORS as e:
+            # Left stale, so the next round picks the channel up again.
+            logging.warning(f"Transient error while re-checking {channel_username}: {e!r}")
+            return
+        if opened_comments:
+            statuses[channel_username] = STATUS_OPEN
+        elif closed_comments:
+            statuses[channel_username] = STATUS_CLOSED
+        else:
+            statuses[channel_username] = None
+
+    async def on_checked(channel_username):
+        if channel_username not in statuses:
+            return
+        status = statuses.pop(channel_username)
+        async with get_db() as db:
+            previous = await update_watched(db, channel_username, status)
+        for chat_id, old_status in previous.items():
+            if status and old_status and status != old_status:
+                opened, closed = changes.setdefault(chat_id, ([], []))
+                (opened if status == STATUS_OPEN else closed).append(channel_username)
+
+    await ENGINE.run(usernames, check, on_checked, SHUTTING_DOWN, "watch", PRIORITY_WATCH)
+    for chat_id, (opened, closed) in changes.items():
+        # The new statuses are stored already, so one chat must not cost the others their changes.
+        try:
+            await BOT.send_message(chat_id, format_changes(opened, closed))
+        except Exception as e:
+            logging.error(f"Error while sending watch changes to chat {chat_id}: {e}")
+
+
+async def watch_scheduler():
+    """Re-checks the watched channels in small batches spread over WATCH_INTERVAL.
+
+    Every WATCH_TICK seconds it takes the share of the watched channels that
+    keeps the whole set checked once per interval, stalest first.
+    """
+
+    while not SHUTTING_DOWN.is_set():
+        try:
+            async with get_db() as db:
+                batch = math.ceil(await count_watched(db) * WATCH_TICK / WATCH_INTERVAL)
+                usernames = await get_due_channels(db, WATCH_INTERVAL, batch) if batch else []
+            if usernames:
+                logging.info(f"Re-checking {len(usernames)} watched channels...")
+                await check_watched(usernames)
+        except Exception as e:
+            logging.error(f"Error while re-checking watched channels: {e}")
+        try:
+            await asyncio.wait_for(SHUTTING_DOWN.wait(), WATCH_TICK)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def cleanup_scheduler():
+    """Every JOB_CLEANUP_INTERVAL seconds deletes the finished jobs older than JOB_RETENTION."""
+
+    while not SHUTTING_DOWN.is_set():
+        try:
+            async with get_db() as db:
+                deleted = await delete_finished_jobs(db, time.time() - JOB_RETENTION)
+            if deleted:
+                logging.info(f"Deleted {deleted} finished jobs.")
+        except Exception as e:
+            logging.error(f"Error while deleting finished jobs: {e}")
+        try:
+            await asyncio.wait_for(SHUTTING_DOWN.wait(), JOB_CLEANUP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def authenticate(token: str):
+    async with get_db() as db:
+        return await get_user_by_token(db, hash_token(token))
+
+
+def result_row(channel_username: str, opened_comments: dict, closed_comments: dict, errors: dict) -> dict:
+    """Takes a checked channel out of the result dicts as one line of the API response."""
+
+    result, error = task_result(channel_username, opened_comments, closed_comments, errors)
+    record = opened_comments.pop(channel_username, None) or closed_comments.pop(channel_username, None)
+    errors.pop(channel_username, None)
+    if record:
+        return {"username": channel_username, "status": result, "channel_id": record.id, "title": record.title}
+    return {"username": channel_username, "status": result, "error": error}
+
+
+async def stream_checks(user_id: int, batches: AsyncIterator[List[str]], emit: Callable[[dict], Awaitable[None]]):
+    """Checks the channels of an API request and passes each result to `emit` as soon as it is known.
+
+    The channels go through the engine API_CHUNK_SIZE at a time, with the
+    cache, the rate limits and the user's daily quota, like a file sent to
+    the bot. The rows are written by a separate task, so a slow client
+    holds back the next chunk instead of the engine's workers.
+    """
+
+    cancelled = asyncio.Event()
+    rows = asyncio.Queue()
+
+    def on_shutdown(future: asyncio.Future):
+        if not future.cancelled():
+            cancelled.set()
+
+    async def write_rows():
+        while True:
+            row = await rows.get()
+            try:
+                if not cancelled.is_set():
+                    await emit(row)
+            except ConnectionError:
+                logging.info(f"API client of user {user_id} went away, stopping its checks.")
+                cancelled.set()
+            finally:
+                rows.task_done()
+
+    opened_comments, closed_comments, errors, retries = {}, {}, {}, {}
+    priority = PRIORITY_ADMIN if str(user_id) == USER_ID else PRIORITY_BULK
+
+    async def check(channel_username):
+        await check_channel(channel_username, opened_comments, closed_comments, errors, False, retries)
+
+    async def on_checked(channel_username):
+        row = result_row(channel_username, opened_comments, closed_comments, errors)
+        CHANNELS_CHECKED.inc(result=row['status'])
+        rows.put_nowait(row)
+
+    shutdown = asyncio.ensure_future(SHUTTING_DOWN.wait())
+    shutdown.add_done_callback(on_shutdown)
+    writer = asyncio.create_task(write_rows())
+    try:
+        async for channels in batches:
+            if cancelled.is_set():
+                break
+            granted = await grant_quota(user_id, len(channels))
+            for channel_username in channels[granted:]:
+                rows.put_nowait({"username": channel_username, "status": STATUS_ERROR, "error": "Daily quota reached"})
+            channels = channels[:granted]
+            for start in range(0, len(channels), API_CHUNK_SIZE):
+                await ENGINE.run(channels[start:start + API_CHUNK_SIZE], check, on_checked, cancelled, user_id, priority)
+                if cancelled.is_set():
+                    break
+                # Back-pressure: no more than about two chunks of rows wait for a slow client.
+                if rows.qsize() >= API_CHUNK_SIZE:
+                    await rows.join()
+        await rows.join()
+    finally:
+        shutdown.cancel()
+        writer.cancel()
+
+
 async def track_user_middleware(event: types.Update, next_call):
     if event.message and event.message.from_user:
         await add_user(event.message.from_user)
     await next_call()
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
-latest_opened = {}
-latest_closed = {}
-latest_errors = {}
-
-
-@DP.callback_query_handler(lambda c: c.data == 'cancel')
 async def cancel(callback_query: types.CallbackQuery):
-    CANCELATION_FLAG[callback_query.message.chat.id] = True
+    """Cancels the job whose progress message has the button: cancel:<job_id>"""
+
+    session = SESSIONS.peek(callback_query.message.chat.id)
+    job_id = callback_query.data.partition(":")[2]
+    if session and job_id.isdigit():
+        session.cancel(int(job_id))
 
 
-@DP.callback_query_handler(lambda c: c.data == 'unchecked')
 async def unchecked(callback_query: types.CallbackQuery):
-    global FILENAME
-    try:
-        if os.path.getsize(FILENAME) > 0:
-            await BOT.send_document(chat_id=callback_query.message.chat.id, document=InputFile(FILENAME), caption=FILENAME)
-    except FileNotFoundError:
-        logging.warning(f"File {FILENAME} not found")
-        await callback_query.message.reply("File with unchecked channels not found")
+    chat_id = callback_query.message.chat.id
+    async with get_db() as db:
+        job = await get_latest_job(db, chat_id)
+    if not job:
+        await callback_query.message.reply("There are no unchecked channels")
+        return
+
+    filename = job_file_stem(job, "unchecked_channels")
+    await send_job_results(chat_id, job['id'], (TASK_PENDING,), filename, filename, force_document=True,
+                           empty_text="There are no unchecked channels")
 
 
-@DP.message_handler(commands=['start', 'help'])
 async def start_help(message: types.Message):
     await message.reply(BANNER)
 
 
-@DP.callback_query_handler(lambda c: c.data == 'view_checked')
+async def reply_latest_results(callback_query: types.CallbackQuery, results: Sequence[str], caption: str,
+                               filename: str, empty_text: str, force_document: bool = False):
+    message = callback_query.message
+    async with get_db() as db:
+        job = await get_latest_job(db, message.chat.id)
+    if not job:
+        await message.reply(empty_text)
+        return
+    await send_job_results(message.chat.id, job['id'], results, caption, job_file_stem(job, filename),
+                           force_document=force_document, empty_text=empty_text, reply_to_message_id=message.message_id)
+
+
 async def view_checked(callback_query: types.CallbackQuery):
-    global FILENAME
-    chat_id = callback_query.message.chat.id
-    if FILENAME:
-        filename = FILENAME[:-4]
-    else:
-        filename = "checked_channels"
-    if chat_id in CHECKED_CHANNELS:
-
-        with tempfile.NamedTemporaryFile(mode="w+t", delete=False, prefix=f"{filename}", suffix=".txt") as f:
-            f.write("opened:\n\n")
-            f.write('\n'.join(CHECKED_CHANNELS[chat_id]['opened_comments']))
-            f.write("\n\nclosed:\n\n")
-            f.write('\n'.join(CHECKED_CHANNELS[chat_id]['closed_comments']))
-            f.write("\n\nerror:\n\n")
-            f.write('\n'.join(CHECKED_CHANNELS[chat_id]['errors']))
-            f.seek(0)
-            file_path = f.name
-
-        with open(file_path, 'rb') as f:
-            await BOT.send_document(chat_id=chat_id, document=InputFile(f), caption="Checked channels")
-
-        os.unlink(file_path)
-    else:
-        await BOT.send_message(chat_id, "No channels have been checked yet.")
+    await reply_latest_results(callback_query, CHECKED_RESULTS, "Checked channels", "checked_channels",
+                               "No channels have been checked yet.", force_document=True)
 
 
-@DP.callback_query_handler(lambda c: c.data == 'opened')
 async def show_opened(callback_query: types.CallbackQuery):
-    chat_id = callback_query.message.chat.id
-    if chat_id in latest_opened:
-        opened_list = "\n".join(
-            f"- {username}" for username in latest_opened[chat_id])
-
-        if len(latest_opened[chat_id]) > 50:
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".txt", prefix="opened_") as tmp:
-                tmp.write(
-                    f"Channels with opened comments from the latest request:\n\n{opened_list}")
-                tmp.flush()
-
-            with open(tmp.name, "rb") as file:
-                await callback_query.message.reply_document(file, caption="Opened comments from the latest request:")
-            os.remove(tmp.name)
-        else:
-            await callback_query.message.reply(f"Channels with opened comments from the latest request:\n\n{opened_list}")
-    else:
-        await callback_query.message.reply("No opened comments from the latest request.")
+    await reply_latest_results(callback_query, (STATUS_OPEN,), "Channels with opened comments from the latest request:",
+                               "opened", "No opened comments from the latest request.")
 
 
-@DP.callback_query_handler(lambda c: c.data == 'closed')
 async def show_closed(callback_query: types.CallbackQuery):
-    chat_id = callback_query.message.chat.id
-    if chat_id in latest_closed:
-        closed_list = "\n".join(
-            f"- {username}" for username in latest_closed[chat_id])
-
-        if len(latest_closed[chat_id]) > 50:
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".txt", prefix="closed_") as tmp:
-                tmp.write(
-                    f"Channels with closed comments from the latest request:\n\n{closed_list}")
-                tmp.flush()
-
-            with open(tmp.name, "rb") as file:
-                await callback_query.message.reply_document(file, caption="Closed channels from the latest request:")
-            os.remove(tmp.name)
-        else:
-            await callback_query.message.reply(f"Channels with closed comments from the latest request:\n\n{closed_list}")
-    else:
-        await callback_query.message.reply("No closed channels from the latest request.")
+    await reply_latest_results(callback_query, (STATUS_CLOSED,), "Channels with closed comments from the latest request:",
+                               "closed", "No closed channels from the latest request.")
 
 
-@DP.callback_query_handler(lambda c: c.data == 'errors')
 async def show_errors(callback_query: types.CallbackQuery):
-    chat_id = callback_query.message.chat.id
-    if chat_id in latest_errors:
-        errors_list = "\n".join(
-            f"- {username}" for username in latest_errors[chat_id])
-
-        if len(latest_errors[chat_id]) > 50:
-            with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".txt", prefix="errors_") as tmp:
-                tmp.write(f"Channel name does not exist:\n\n{errors_list}")
-                tmp.flush()
-
-            with open(tmp.name, "rb") as file:
-                await callback_query.message.reply_document(file, caption="Errors from the latest request:")
-            os.remove(tmp.name)
-        else:
-            await callback_query.message.reply(f"Channel name does not exist:\n\n{errors_list}")
-    else:
-        await callback_query.message.reply("No errors from the latest request.")
+    await reply_latest_results(callback_query, (STATUS_ERROR,), "Errors from the latest request:",
+                               "errors", "No errors from the latest request.")
+
+
+async def export_results(message: types.Message):
+    """Sends the results of the latest job as a file: /export [opened|closed|errors|unchecked|all] [txt|csv|jsonl]"""
+
+    args = message.get_args().lower().split()
+    fmt = next((arg for arg in args if arg in EXPORT_FORMATS), EXPORT_TXT)
+    kind = next((arg for arg in args if arg in EXPORT_RESULTS), "all")
+    async with get_db() as db:
+        job = await get_latest_job(db, message.chat.id)
+    if not job:
+        await message.reply("No channels have been checked yet.")
+        return
+    await send_job_results(message.chat.id, job['id'], EXPORT_RESULTS[kind], f"Results: {kind}",
+                           f"{job_file_stem(job, 'results')}_{kind}", fmt, force_document=True,
+                           empty_text="Nothing to export.", reply_to_message_id=message.message_id)
+
+
+async def users_page(after_id: int = None, before_id: int = None):
+    """Renders one page of the user list with buttons for the pages around it."""
+
+    await DATABASE.flush_users()
+    async with get_db() as db:
+        users, has_previous, has_next = await get_users_page(db, after_id, before_id, USERS_PAGE_SIZE)
+        total = await count_users(db)
+        active = await count_users(db, time.time() - 24 * 60 * 60)
+    lines = [f"Users: {total}, active in the last 24 hours: {active}", ""]
+    lines += [format_user(user) for user in users] or ["No users."]
+    keyboard = InlineKeyboardMarkup()
+    buttons = []
+    if users and has_previous:
+        buttons.append(InlineKeyboardButton("◀ Previous", callback_data=f"users:before:{users[0]['id']}"))
+    if users and has_next:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"users:after:{users[-1]['id']}"))
+    if buttons:
+        keyboard.add(*buttons)
+    return "\n".join(lines), keyboard
 
 
-@DP.message_handler(commands=['list_users'])
 async def list_users(message: types.Message):
-    if str(message.from_user.id) == USER_ID:
-        users_data = await get_users()
-        response = "Users:\n\n"
-        for idx, user in enumerate(users_data, start=1):
-            response += f"**User {idx}**\n"
-            response += f"- ID: `{user['id']}`\n"
-            response += f"- Username: `@{user['username']}`\n"
-            response += f"- First Name: `{user['first_name']}`\n"
-            response += f"- Last Name: `{user['last_name'] or 'None'}`\n"
-            response += "\n"
-        await message.reply(response, parse_mode='Markdown')
+    """Lists the users page by page, or finds them by id or username: /list_users [id|username]"""
+
+    if str(message.from_user.id) != USER_ID:
+        await message.reply("You are not authorized to use this command.")
+        return
+    query = message.get_args()
+    if query:
+        await DATABASE.flush_users()
+        async with get_db() as db:
+            users = await search_users(db, query, USERS_PAGE_SIZE)
+        await message.reply("\n".join(format_user(user) for user in users) or "No users found.")
+        return
+    text, keyboard = await users_page()
+    await message.reply(text, reply_markup=keyboard)
+
+
+async def turn_users_page(callback_query: types.CallbackQuery):
+    if str(callback_query.from_user.id) != USER_ID:
+        await callback_query.answer("You are not authorized to use this command.")
+        return
+    _, direction, user_id = callback_query.data.split(":")
+    if direction == "after":
+        text, keyboard = await users_page(after_id=int(user_id))
     else:
+        text, keyboard = await users_page(before_id=int(user_id))
+    await callback_query.message.edit_text(text, reply_markup=keyboard)
+    await callback_query.answer()
+
+
+async def top_users(message: types.Message):
+    """Shows the users that checked the most channels."""
+
+    if str(message.from_user.id) != USER_ID:
         await message.reply("You are not authorized to use this command.")
+        return
+    await DATABASE.flush_users()
+    async with get_db() as db:
+        users = await get_top_users(db, USERS_PAGE_SIZE)
+    await message.reply("Top users by checked channels:\n\n" + "\n".join(format_user(user) for user in users)
+                        if users else "No channels have been checked yet.")
 
 
-@DP.message_handler(lambda message: message.text and "@" in message.text)
-async def handle_text(message: types.Message):
-    CANCELATION_FLAG[message.chat.id] = False
-    pattern = r"(?:https?://tgstat\.ru/channel/)?@([\w\d]+)(?:/stat)?"
-    channels = set("@" + match.group(1) if not match.group(1).startswith("@")
-                   else match.group(1) for match in re.finditer(pattern, message.text))
+async def export_users(message: types.Message):
+    """Sends the whole users table as a CSV file, written row by row from the database."""
 
-    async with get_telethon_client() as telethon_client:
+    if str(message.from_user.id) != USER_ID:
+        await message.reply("You are not authorized to use this command.")
+        return
+    await DATABASE.flush_users()
+    async with get_db() as db:
+        total = await count_users(db)
+        export = ResultExport(EXPORT_CSV, compress=total >= EXPORT_GZIP_THRESHOLD, columns=USER_FIELDS)
         try:
-            opened_comments, closed_comments, errors = await check_channels(telethon_client, channels, message)
-        except ChannelInvalidError as e:
-            errors.append(e.username)
+            async for user in iter_users(db):
+                export.write(user)
+            with RPC_LATENCY.time(method="send_document"):
+                await BOT.send_document(message.chat.id, export.finish("users.csv"), caption=f"Users: {total}",
+                                        reply_to_message_id=message.message_id)
+        finally:
+            export.close()
+
+
+def format_stats() -> str:
+    lines = ["Telegram API calls:"]
+    for method in ("get_entity", "GetFullChannelRequest", "edit_text", "send_message", "send_document"):
+        count, total = RPC_LATENCY.summary(method=method)
+        average = f"{total / count * 1000:.0f} ms" if count else "-"
+        lines.append(f"- {method}: {count} calls, avg {average}")
+
+    hits, lookups = CACHE_LOOKUPS.total(result="hit"), CACHE_LOOKUPS.total()
+    jobs, channels_per_second = JOB_THROUGHPUT.summary()
+    lines += [
+        "",
+        f"Flood waits: {FLOOD_WAITS.total():.0f} ({FLOOD_WAIT_SECONDS.total():.0f} s)",
+        f"Cache hit ratio: {hits / lookups:.0%}" if lookups else "Cache hit ratio: -",
+        f"Queue depth: {ENGINE.queue_depth} ({ENGINE.workers} workers)",
+        f"Channels checked: {CHANNELS_CHECKED.total():.0f}",
+        f"Finished jobs: {jobs}, avg {channels_per_second / jobs:.1f} channels/s" if jobs else "Finished jobs: 0",
+        "",
+        "SQLite writes:",
+    ]
+    for operation in ("complete_task", "save_status", "save_entity", "add_tasks", "flush_users"):
+        count, total = DB_WRITE_LATENCY.summary(operation=operation)
+        if count:
+            lines.append(f"- {operation}: {count} writes, avg {total / count * 1000:.1f} ms")
+    return "\n".join(lines)
+
+
+async def show_stats(message: types.Message):
+    if str(message.from_user.id) == USER_ID:
+        await message.reply(format_stats())
+    else:
+        await message.reply("You are not authorized to use this command.")
+
 
-    latest_opened[message.chat.id] = opened_comments
-    latest_errors[message.chat.id] = errors
-    latest_closed[message.chat.id] = closed_comments
+async def list_accounts(message: types.Message):
+    if str(message.from_user.id) == USER_ID:
+        response = "Accounts:\n\n" + "\n".join(CLIENT_POOL.stats())
+        await message.reply(response)
+    else:
+        await message.reply("You are not authorized to use this command.")
 
-    await send_summary(message.chat.id, opened_comments, closed_comments, errors)
-    if len(opened_comments) > 50 or (message.text and message.text.startswith("/opened_file")):
-        await send_channels_file(message.chat.id, opened_comments, "opened")
 
+async def add_to_watch_list(message: types.Message, usernames: List[str]):
+    usernames = [username for username in usernames if is_valid_username(username)]
+    limit = 0 if str(message.from_user.id) == USER_ID else WATCH_LIMIT
+    async with get_db() as db:
+        added = await watch_channels(db, message.chat.id, usernames, limit) if usernames else 0
+        total = await count_watched(db, message.chat.id)
+    if not usernames:
+        await message.reply(f"Watching {total} channels. Send /watch @channel1 @channel2 (or a file with /watch as "
+                            "the caption) to add channels and /unwatch to remove them.")
+        return
+    text = f"Added {added} channels, watching {total}. You will get a message when their comments open or close."
+    if limit and total >= limit:
+        text += f"\nThe watch list is limited to {limit} channels."
+    await message.reply(text)
 
-@DP.message_handler(content_types=['document'])
-async def handle_file(message: types.Message):
-    global FILENAME
-    FILENAME = message.document.file_name
-    CANCELATION_FLAG[message.chat.id] = False
-    document = message.document
-    file_bytes = await BOT.download_file_by_id(document.file_id)
 
-    pattern = r"(?:https?://tgstat\.ru/channel/)?@([\w\d]+)(?:/stat)?"
-    channels = set("@" + match.group(1) if not match.group(1).startswith("@") else match.group(1)
-                   for match in re.finditer(pattern, file_bytes.getvalue().decode()))
+async def watch(message: types.Message):
+    """Adds channels to the watch list of the chat: /watch @channel1 @channel2"""
 
-    async with get_telethon_client() as telethon_client:
-        try:
-            opened_comments, closed_comments, errors = await check_channels(telethon_client, channels, message)
-        except ChannelInvalidError as e:
-            errors.append(e.username)
+    await add_to_watch_list(message, extract_usernames(message.get_args() or ""))
+
+
+async def unwatch(message: types.Message):
+    """Removes channels from the watch list of the chat, or all of them: /unwatch [@channel1 @channel2]"""
+
+    args = message.get_args()
+    async with get_db() as db:
+        removed = await unwatch_channels(db, message.chat.id, extract_usernames(args) if args else None)
+    await message.reply(f"Removed {removed} channels from the watch list.")
+
+
+async def api_token(message: types.Message):
+    """Gives the user a new token for the batch-check API; the old one stops working."""
+
+    if not API_PORT:
+        await message.reply("The batch-check API is not enabled.")
+        return
+    token = secrets.token_urlsafe(32)
+    await DATABASE.flush_users()
+    async with get_db() as db:
+        await set_api_token(db, message.from_user.id, hash_token(token))
+    await message.reply(f"Your API token (keep it secret, it replaces the previous one):\n\n{token}")
 
-    latest_opened[message.chat.id] = opened_comments
-    latest_errors[message.chat.id] = errors
-    latest_closed[message.chat.id] = closed_comments
 
-    await send_summary(message.chat.id, opened_comments, closed_comments, errors)
-    if len(opened_comments) > 50 or (message.text and message.text.startswith("/opened_file")):
-        await send_channels_file(message.chat.id, opened_comments, "opened")
+async def handle_text(message: types.Message):
+    channels = await apply_quota(message, extract_usernames(message.text))
+    if not channels:
+        return
+    force_refresh = message.text.startswith("/refresh")
+
+    job_id, results = await check_channels(channels, message, force_refresh,
+                                           priority=job_priority(message, interactive=True))
+    if results is None:
+        return
+    opened_comments, closed_comments, errors = results
+
+    await publish_results(message.chat.id, opened_comments, closed_comments, errors)
+    if len(opened_comments) > EXPORT_INLINE_LIMIT or message.text.startswith("/opened_file"):
+        await send_job_results(message.chat.id, job_id, (STATUS_OPEN,), "Opened", "opened", force_document=True)
+
+
+async def handle_file(message: types.Message):
+    document = message.document
+    batches = parse_channel_stream(iter_document_chunks(document), detect_format(document.file_name))
+    if (message.caption or "").startswith("/watch"):
+        await add_to_watch_list(message, [channel async for channels in batches for channel in channels])
+        return
+    force_refresh = bool(message.caption and message.caption.startswith("/refresh"))
+
+    job_id, results = await check_channel_stream(batches, message, force_refresh, document.file_name,
+                                                 job_priority(message, interactive=False))
+    if results is None:
+        return
+    opened_comments, closed_comments, errors = results
+
+    await publish_results(message.chat.id, opened_comments, closed_comments, errors)
+    if len(opened_comments) > EXPORT_INLINE_LIMIT or (message.caption or "").startswith("/opened_file"):
+        await send_job_results(message.chat.id, job_id, (STATUS_OPEN,), "Opened", "opened", force_document=True)
+
+
+def register_handlers(dp: Dispatcher):
+    """Registers the handlers, in the order they are tried."""
+
+    dp.register_callback_query_handler(cancel, lambda c: c.data.startswith('cancel:'))
+    dp.register_callback_query_handler(unchecked, lambda c: c.data == 'unchecked')
+    dp.register_message_handler(start_help, commands=['start', 'help'])
+    dp.register_callback_query_handler(view_checked, lambda c: c.data == 'view_checked')
+    dp.register_callback_query_handler(show_opened, lambda c: c.data == 'opened')
+    dp.register_callback_query_handler(show_closed, lambda c: c.data == 'closed')
+    dp.register_callback_query_handler(show_errors, lambda c: c.data == 'errors')
+    dp.register_message_handler(export_results, commands=['export'])
+    dp.register_message_handler(list_users, commands=['list_users'])
+    dp.register_callback_query_handler(turn_users_page, lambda c: c.data.startswith('users:'))
+    dp.register_message_handler(top_users, commands=['top_users'])
+    dp.register_message_handler(export_users, commands=['export_users'])
+    dp.register_message_handler(show_stats, commands=['stats'])
+    dp.register_message_handler(list_accounts, commands=['accounts'])
+    dp.register_message_handler(watch, commands=['watch'])
+    dp.register_message_handler(unwatch, commands=['unwatch'])
+    dp.register_message_handler(api_token, commands=['api_token'])
+    dp.register_message_handler(handle_text, lambda message: message.text and is_channel_list(message.text))
+    dp.register_message_handler(handle_file, content_types=['document'])
+
+
+def create_app() -> Dispatcher:
+    """Builds the bot, the dispatcher and the client pool and registers the handlers.
+
+    Nothing of this exists before it is called; the database and the
+    Telethon clients are connected later by on_startup.
+    """
+
+    global BOT, DP, CLIENT_POOL, USER_ID
+    if not USER_ID:
+        USER_ID = input(
+            "TELEGRAM_USER_ID is unset in '.env'. Please enter TELEGRAM_USER_ID: ")
+    BOT = Bot(BOT_TOKEN)
+    DP = Dispatcher(BOT)
+    CLIENT_POOL = ClientPool(API_ID, API_HASH, BOT_TOKENS, SESSION_NAME, CLIENT_HEALTH_INTERVAL,
+                             (GET_ENTITY_RATE, GET_ENTITY_BURST), (FULL_CHANNEL_RATE, FULL_CHANNEL_BURST))
+    DP.middleware.setup(UserTrackingMiddleware())
+    DP.middleware.setup(LoggingMiddleware())
+    register_handlers(DP)
+    return DP
 
 
 async def on_startup(dp):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                chat_id INTEGER
-            )
-        """)
+    global METRICS_SERVER, WATCH_TASK, CLEANUP_TASK, TASK_QUEUE, API_SERVER
+    # Left set by the on_shutdown of a previous run when main() is restarted.
+    SHUTTING_DOWN.clear()
+    await DATABASE.connect(DB_NAME)
+    async with get_db() as db:
+        await db.execute(CREATE_USERS_TABLE)
+        await db.execute(CREATE_CHANNEL_STATUS_TABLE)
+        await db.execute(CREATE_CHANNEL_ENTITIES_TABLE)
+        await db.execute(CREATE_JOBS_TABLE)
+        await db.execute(CREATE_JOBS_STATUS_INDEX)
+        await db.execute(CREATE_JOB_TASKS_TABLE)
+        await db.execute(CREATE_JOB_TASKS_INDEX)
+        await db.execute(CREATE_JOB_TASKS_ORDER_INDEX)
+        await db.execute(CREATE_WATCHED_CHANNELS_TABLE)
+        await db.execute(CREATE_WATCHED_CHANNELS_INDEX)
+        await db.commit()
+        await ensure_columns(db, "users", USER_QUOTA_COLUMNS)
+        await ensure_columns(db, "users", USER_COLUMNS)
+        for statement in CREATE_USERS_INDEXES:
+            await db.execute(statement)
         await db.commit()
+        running_jobs = await get_running_jobs(db)
+    await DATABASE.load_known_users()
+    TASK_QUEUE = SQLiteTaskQueue(await open_connection(DB_NAME), WORKER_ID, LEASE_SECONDS, MAX_TASK_ATTEMPTS)
+    # The front process only enqueues jobs; the workers own the Telethon accounts.
+    if ROLE != ROLE_FRONT:
+        await CLIENT_POOL.start()
+    if METRICS_PORT:
+        METRICS_SERVER = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if API_PORT and ROLE != ROLE_FRONT:
+        API_SERVER = await start_api_server(API_HOST, API_PORT, authenticate, stream_checks)
+    if ROLE != ROLE_WORKER:
+        if BOT_MODE == "webhook" and WEBHOOK_URL:
+            await BOT.set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
+            logging.info(f"Webhook set to {WEBHOOK_URL + WEBHOOK_PATH}.")
+        for job in running_jobs:
+            asyncio.create_task(resume_job(job))
+        if JOB_RETENTION:
+            CLEANUP_TASK = asyncio.create_task(cleanup_scheduler())
+    if WATCH_INTERVAL and ROLE != ROLE_FRONT:
+        WATCH_TASK = asyncio.create_task(watch_scheduler())
+
+
+async def drain_jobs():
+    """Stops the running jobs, leaving their unchecked channels in the queue."""
+
+    SHUTTING_DOWN.set()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while SESSIONS.running_jobs() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if SESSIONS.running_jobs():
+        logging.warning(f"{SESSIONS.running_jobs()} jobs were still running after {SHUTDOWN_TIMEOUT} s.")
 
 
 async def on_shutdown(dp):
     try:
+        await drain_jobs()
+        if WATCH_TASK:
+            WATCH_TASK.cancel()
+        if CLEANUP_TASK:
+            CLEANUP_TASK.cancel()
+        await ENGINE.stop()
+        if API_SERVER:
+            await API_SERVER.cleanup()
+        if METRICS_SERVER:
+            await METRICS_SERVER.cleanup()
+        await CLIENT_POOL.close()
+        if TASK_QUEUE:
+            await TASK_QUEUE.close()
+        await DATABASE.close()
         await BOT.close()
-        if FILENAME:
-            os.remove(FILENAME)
     except Exception as e:
         logging.error(f"Error while closing bot: {e}")
     finally:
         logging.info("Bot closed.")
 
 
+async def check_leased(tasks: List[dict]):
+    """Checks tasks leased from the queue and writes their results back.
+
+    The tasks of each job go through the engine with the job's chat and
+    priority; tasks left unchecked by a shutdown are released.
+    """
+
+    jobs = {}
+    for task in tasks:
+        jobs.setdefault(task['job_id'], {})[task['username']] = task
+
+    async def run(leased: dict):
+        first = next(iter(leased.values()))
+        opened_comments, closed_comments, errors, retries = {}, {}, {}, {}
+
+        async def check(channel_username):
+            await check_channel(channel_username, opened_comments, closed_comments, errors, first['force_refresh'],
+                                retries)
+
+        async def on_checked(channel_username):
+            result, error = task_result(channel_username, opened_comments, closed_comments, errors)
+            with DB_WRITE_LATENCY.time(operation="complete_task"):
+                await TASK_QUEUE.complete(leased.pop(channel_username), result, error)
+            CHANNELS_CHECKED.inc(result=result)
+
+        try:
+            await ENGINE.run(list(leased), check, on_checked, SHUTTING_DOWN, first['chat_id'], first['priority'])
+        finally:
+            if leased:
+                await TASK_QUEUE.release(list(leased.values()))
+
+    await asyncio.gather(*(run(leased) for leased in jobs.values()))
+
+
+async def run_worker():
+    """Takes channel tasks from the shared queue until the process is stopped."""
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, SHUTTING_DOWN.set)
+    await on_startup(None)
+    logging.info(f"Worker {WORKER_ID} is waiting for tasks...")
+    try:
+        while not SHUTTING_DOWN.is_set():
+            try:
+                tasks = await TASK_QUEUE.lease(LEASE_BATCH)
+                if tasks:
+                    await check_leased(tasks)
+                    continue
+            except Exception as e:
+                logging.error(f"Error while checking leased tasks: {e}")
+            try:
+                await asyncio.wait_for(SHUTTING_DOWN.wait(), QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await on_shutdown(None)
+
+
 def main():
-    executor.start_polling(DP, on_startup=on_startup, on_shutdown=on_shutdown)
+    if ROLE == ROLE_WORKER:
+        asyncio.get_event_loop().run_until_complete(run_worker())
+    elif BOT_MODE == "webhook":
+        # Updates are POSTed to http://WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH,
+        # so the handlers can be tried locally without Telegram.
+        executor.start_webhook(DP, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown,
+                               host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        executor.start_polling(DP, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    create_app()
     while True:
         try:
             main()
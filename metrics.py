@@ -0,0 +1,156 @@
+# Standard library imports
+import bisect
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+THROUGHPUT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    """Base class of the metrics, keyed by the values of their labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Returns the exposition lines of the metric's values."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        """Sum over all series that match the given labels."""
+        wanted = {self.labels.index(name): str(value) for name, value in labels.items()}
+        return sum(total for key, total in self.values.items()
+                   if all(key[index] == value for index, value in wanted.items()))
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value that is read from `function` whenever the metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # Counts per bucket (the last one is +Inf), sum and count.
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the block took, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self, **labels) -> Tuple[int, float]:
+        """Returns the count and sum of the series with the given labels."""
+        series = self.series.get(self._key(labels))
+        return (series[2], series[1]) if series else (0, 0.0)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+# Metrics by name; registering a name again replaces the old metric.
+REGISTRY: Dict[str, Metric] = {}
+
+RPC_LATENCY = Histogram("bot_rpc_latency_seconds", "Latency of Telegram API calls.", ["method"])
+FLOOD_WAITS = Counter("bot_flood_waits_total", "FloodWait errors per account.", ["account"])
+FLOOD_WAIT_SECONDS = Counter("bot_flood_wait_seconds_total", "Seconds of FloodWait per account.", ["account"])
+CACHE_LOOKUPS = Counter("bot_cache_lookups_total", "Channel status cache lookups.", ["result"])
+CHANNELS_CHECKED = Counter("bot_channels_checked_total", "Channels checked, by result.", ["result"])
+JOB_THROUGHPUT = Histogram("bot_job_throughput_channels_per_second", "Channels checked per second by finished jobs.",
+                           buckets=THROUGHPUT_BUCKETS)
+DB_WRITE_LATENCY = Histogram("bot_db_write_seconds", "Latency of SQLite writes.", ["operation"])
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY.values()) + "\n"
+
+
+async def start_metrics_server(host: str, port: int):
+    """Serves the metrics on http://host:port/metrics and returns the aiohttp AppRunner."""
+
+    # Imported here so the metrics themselves can be used without aiohttp.
+    from aiohttp import web
+
+    async def _metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    logging.info(f"Starting metrics server on {host}:{port}...")
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Metrics server started.")
+    return runner
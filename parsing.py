@@ -0,0 +1,91 @@
+# Standard library imports
+import codecs
+from typing import AsyncIterator, List
+
+# Local imports
+from extractor import iter_usernames
+
+CHUNK_SIZE = 64 * 1024
+
+# Characters that can never be part of a channel link, so a chunk can be
+# safely cut after any of them without splitting a match. Chunks are cut
+# at line ends whenever possible, so bare usernames keep their whole line.
+BOUNDARIES = " \t\r,;\"'<>[]{}()"
+MAX_TAIL = 1024
+TAIL_KEEP = 128
+
+FORMAT_TEXT = "text"
+FORMAT_CSV = "csv"
+FORMAT_JSON = "json"
+
+
+def detect_format(filename: str) -> str:
+    """Guesses the export format from the uploaded file name."""
+
+    name = (filename or "").lower()
+    if name.endswith(".json"):
+        return FORMAT_JSON
+    if name.endswith(".csv"):
+        return FORMAT_CSV
+    return FORMAT_TEXT
+
+
+class ChannelStreamParser:
+    """Extracts channel usernames from a file that arrives chunk by chunk.
+
+    Text after the last line end (or, for very long lines, the last boundary
+    character) of a chunk is carried over to the next one, so links split
+    between chunks are still found. Every username is returned only once.
+    """
+
+    def __init__(self, fmt: str = FORMAT_TEXT):
+        self.fmt = fmt
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._tail = ""
+        # False after a long line was cut in the middle.
+        self._tail_starts_line = True
+        self._seen = set()
+
+    def feed(self, data: bytes) -> List[str]:
+        text = self._tail + self._decoder.decode(data)
+        starts_line = self._tail_starts_line
+        cut = text.rfind("\n") + 1
+        ends_line = cut > 0
+        if cut == 0 and len(text) > MAX_TAIL:
+            cut = max(text.rfind(c) for c in BOUNDARIES) + 1
+        if cut == 0 and len(text) > MAX_TAIL:
+            cut = len(text) - TAIL_KEEP
+        if cut:
+            self._tail_starts_line = ends_line
+        self._tail = text[cut:]
+        return self._extract(text[:cut], starts_line, ends_line)
+
+    def close(self) -> List[str]:
+        text = self._tail + self._decoder.decode(b"", final=True)
+        self._tail = ""
+        return self._extract(text, self._tail_starts_line, True)
+
+    def _extract(self, text: str, starts_line: bool, ends_line: bool) -> List[str]:
+        if self.fmt == FORMAT_JSON:
+            text = text.replace("\\/", "/")
+        channels = []
+        for channel in iter_usernames(text, starts_line, ends_line):
+            # Hashes take far less memory than the strings for large exports.
+            key = hash(channel)
+            if key not in self._seen:
+                self._seen.add(key)
+                channels.append(channel)
+        return channels
+
+
+async def parse_channel_stream(chunks: AsyncIterator[bytes], fmt: str = FORMAT_TEXT) -> AsyncIterator[List[str]]:
+    """Yields batches of new usernames as soon as they are found in the stream."""
+
+    parser = ChannelStreamParser(fmt)
+    async for chunk in chunks:
+        channels = parser.feed(chunk)
+        if channels:
+            yield channels
+    channels = parser.close()
+    if channels:
+        yield channels
@@ -0,0 +1,122 @@
+# Standard library imports
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable
+
+# Third party imports
+from aiogram import types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+# Local imports
+from metrics import RPC_LATENCY
+
+
+class ProgressReporter:
+    """Edits a progress message in the background, merging frequent updates.
+
+    The message is edited at most once every `interval` seconds, or after
+    `min_interval` seconds when progress moved by at least `step` percent.
+    Edits are skipped when the rendered text did not change, and `close`
+    always flushes the final state. While the job waits for a flood-wait to
+    end, the message says when it will resume.
+    """
+
+    def __init__(self, message: types.Message, total: int, render: Callable[..., str], reply_markup=None,
+                 checked: int = 0, interval: float = 5, min_interval: float = 1, step: int = 10, window: int = 50):
+        self.message = message
+        self.total = total
+        self.checked = checked
+        self.render = render
+        self.reply_markup = reply_markup
+        self.interval = interval
+        self.min_interval = min_interval
+        self.step = step
+        self.start_time = time.time()
+        # (time, checked) pairs of recent advances.
+        self._completions = deque([(time.monotonic(), checked)], maxlen=window)
+        self._changed = asyncio.Event()
+        self._last_edit = 0.0
+        self._last_percentage = 0
+        self._last_text = None
+        self._task = None
+        self.paused_until = 0.0
+        self._paused_changed = False
+
+    def _percentage(self) -> int:
+        return int(self.checked / self.total * 100) if self.total else 100
+
+    def seconds_per_channel(self):
+        """Moving average of the time between recently finished checks."""
+        if len(self._completions) < 2:
+            return None
+        (first_time, first_checked), (last_time, last_checked) = self._completions[0], self._completions[-1]
+        return (last_time - first_time) / (last_checked - first_checked)
+
+    def advance(self, count: int = 1):
+        if count <= 0:
+            return
+        self.checked += count
+        self._completions.append((time.monotonic(), self.checked))
+        if self.paused_until:
+            self.paused_until = 0.0
+            self._paused_changed = True
+        self._changed.set()
+
+    def pause(self, resume_at: float):
+        """Shows that the job is paused until the given wall-clock time."""
+        if resume_at != self.paused_until:
+            self.paused_until = resume_at
+            self._paused_changed = True
+            self._changed.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._flush()
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            stepped = self._percentage() - self._last_percentage >= self.step or self._paused_changed
+            delay = self.min_interval if stepped else self.interval
+            since_edit = time.monotonic() - self._last_edit
+            if since_edit < delay:
+                await asyncio.sleep(delay - since_edit)
+            await self._flush()
+
+    async def _flush(self):
+        text = self.render(self.checked, self.total, time.time() - self.start_time,
+                           self.seconds_per_channel())
+        self._paused_changed = False
+        if self.paused_until > time.time():
+            resume_at = datetime.utcfromtimestamp(self.paused_until).strftime("%H:%M")
+            text += f"\nPaused by Telegram flood limits, resuming at {resume_at} UTC."
+        if text == self._last_text:
+            return
+        try:
+            with RPC_LATENCY.time(method="edit_text"):
+                await self.message.edit_text(text, reply_markup=self.reply_markup)
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            logging.warning(f"Progress update throttled for {e.timeout} seconds.")
+            await asyncio.sleep(e.timeout)
+            await self._flush()
+            return
+        except Exception as e:
+            logging.error(f"Error while updating progress: {e}")
+            return
+        self._last_text = text
+        self._last_edit = time.monotonic()
+        self._last_percentage = self._percentage()
@@ -0,0 +1,30 @@
+# Standard library imports
+from datetime import datetime
+
+USER_QUOTA_COLUMNS = {
+    "daily_quota": "INTEGER",
+    "quota_used": "INTEGER NOT NULL DEFAULT 0",
+    "quota_day": "TEXT",
+}
+
+
+async def consume_quota(db, user_id: int, count: int, default_quota: int) -> int:
+    """Takes up to `count` checks from the user's daily quota and returns how many were granted.
+
+    A user's own `daily_quota` overrides the default; a quota of 0 means unlimited.
+    """
+
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    cursor = await db.execute(
+        "SELECT daily_quota, quota_used, quota_day FROM users WHERE id = ?", (user_id,))
+    row = await cursor.fetchone()
+    await cursor.close()
+
+    quota = row[0] if row and row[0] is not None else default_quota
+    used = row[1] if row and row[2] == today else 0
+    granted = count if quota <= 0 else max(0, min(count, quota - used))
+
+    await db.execute("UPDATE users SET quota_used = ?, quota_day = ? WHERE id = ?",
+                     (used + granted, today, user_id))
+    await db.commit()
+    return granted
@@ -0,0 +1,55 @@
+# Standard library imports
+import sys
+from typing import Optional
+
+
+def error_reason(text: str) -> str:
+    """Returns the one shared copy of an error reason, so equal errors cost no extra memory."""
+    return sys.intern(text)
+
+
+# Telethon raises ValueError when no channel has the username.
+EXCEPTION_REASONS = {
+    ValueError: "Channel not found",
+}
+
+
+def exception_reason(error: Exception) -> str:
+    """Returns the reason stored for a check that failed with the exception.
+
+    Reasons depend only on the exception class, never on its text (which
+    names the channel), so there are few of them and all are shared. The
+    full text belongs in the log.
+    """
+
+    for cls in type(error).__mro__:
+        if cls in EXCEPTION_REASONS:
+            return error_reason(EXCEPTION_REASONS[cls])
+    return error_reason(f"Error while processing: {type(error).__name__}")
+
+
+class ChannelResult:
+    """What a job keeps of a checked channel: username, id, title, status and error.
+
+    The status is one of the STATUS_* constants and the error an interned
+    reason, so a result holds references to shared strings instead of a
+    Telethon entity.
+    """
+
+    __slots__ = ("username", "id", "title", "status", "error")
+
+    def __init__(self, username: str, id: Optional[int], title: Optional[str], status: str, error: str = None):
+        self.username = username
+        self.id = id
+        self.title = title
+        self.status = status
+        self.error = error and error_reason(error)
+
+    @classmethod
+    def from_row(cls, row: dict) -> "ChannelResult":
+        """Builds a result from a channel_status or job_tasks row."""
+        return cls(row['username'], row.get('id'), row.get('title'), row.get('status') or row.get('result'),
+                   row.get('error'))
+
+    def __repr__(self):
+        return f"ChannelResult({self.username!r}, {self.status!r})"
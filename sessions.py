@@ -0,0 +1,82 @@
+# Standard library imports
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ChatSession:
+    """Per-chat state: the cancel events of the chat's running jobs.
+
+    Results are not kept here; they are read back from the job tables.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.jobs = {}
+        self.last_used = time.monotonic()
+
+    @property
+    def running(self) -> int:
+        return len(self.jobs)
+
+    def start_job(self, job_id: int) -> asyncio.Event:
+        """Returns the cancel event of a job that starts running in the chat."""
+        return self.jobs.setdefault(job_id, asyncio.Event())
+
+    def finish_job(self, job_id: int):
+        self.jobs.pop(job_id, None)
+        self.last_used = time.monotonic()
+
+    def cancel(self, job_id: int):
+        """Cancels one running job of the chat; other jobs keep running."""
+
+        cancelled = self.jobs.get(job_id)
+        if cancelled:
+            cancelled.set()
+
+
+class SessionStore:
+    """Bounded LRU store of chat sessions.
+
+    Sessions idle for longer than `idle_timeout` seconds are dropped, and the
+    least recently used ones are evicted once there are more than `max_size`.
+    Sessions with a running job are never evicted.
+    """
+
+    def __init__(self, max_size: int = 1000, idle_timeout: float = 24 * 60 * 60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id: int) -> ChatSession:
+        """Returns the session of a chat, creating it if needed."""
+
+        session = self._sessions.pop(chat_id, None) or ChatSession(chat_id)
+        self._evict()
+        self._sessions[chat_id] = session
+        session.last_used = time.monotonic()
+        return session
+
+    def running_jobs(self) -> int:
+        """Number of jobs that are running in all chats."""
+        return sum(session.running for session in self._sessions.values())
+
+    def peek(self, chat_id: int) -> Optional[ChatSession]:
+        """Returns the session of a chat without creating or touching it."""
+        return self._sessions.get(chat_id)
+
+    def _evict(self):
+        expires = time.monotonic() - self.idle_timeout
+        for chat_id, session in list(self._sessions.items()):
+            too_many = len(self._sessions) >= self.max_size
+            if session.last_used > expires and not too_many:
+                break
+            if session.running:
+                continue
+            del self._sessions[chat_id]
+            logging.info(f"Dropped session of chat {chat_id}.")
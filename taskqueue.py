@@ -0,0 +1,106 @@
+# Standard library imports
+import asyncio
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+# Local imports
+from jobs import (add_tasks, complete_task, count_results, count_tasks, count_unfinished, create_job, lease_tasks,
+                  release_tasks)
+
+
+class TaskQueue(ABC):
+    """The channel tasks shared by the front process and the worker processes.
+
+    The front process creates jobs, enqueues their channels and follows
+    their progress; a worker leases tasks, checks them and completes them.
+    Tasks a worker could not check are released, and a lease that runs out
+    makes its tasks available to the other workers again. A task is a dict with `job_id`,
+    `username`, `chat_id`, `force_refresh` and `priority`.
+
+    SQLiteTaskQueue serves processes on one machine that share DB_NAME. A
+    queue for several machines (e.g. on Redis) implements the same methods;
+    one that misses any of them cannot be created.
+    """
+
+    @abstractmethod
+    async def create_job(self, chat_id: int, channels: List[str], filename: str, force_refresh: bool,
+                         priority: int) -> int:
+        """Stores a new job with a task per channel and returns its id."""
+
+    @abstractmethod
+    async def enqueue(self, job_id: int, channels: List[str]):
+        """Adds more channel tasks to a job."""
+
+    @abstractmethod
+    async def progress(self, job_id: int) -> Tuple[int, int]:
+        """Returns how many tasks a job has and how many of them are finished."""
+
+    @abstractmethod
+    async def lease(self, limit: int) -> List[dict]:
+        """Takes up to `limit` tasks for this worker."""
+
+    @abstractmethod
+    async def complete(self, task: dict, result: str, error: str = None):
+        """Stores the result of a leased task."""
+
+    @abstractmethod
+    async def release(self, tasks: List[dict]):
+        """Gives back leased tasks that were not checked, without counting the attempt."""
+
+    @abstractmethod
+    async def unfinished(self, job_id: int) -> int:
+        """Counts the tasks of a job that are still waiting or being checked."""
+
+    async def close(self):
+        """Releases the connections of the queue."""
+
+
+class SQLiteTaskQueue(TaskQueue):
+    """Task queue on the job_tasks table, leasing rows to one worker at a time.
+
+    `db` must be a connection of its own (see database.open_connection):
+    leasing holds a write transaction across awaits, which must not pick up
+    or roll back the writes of other coroutines on the shared connection.
+    The queue's own writes are serialised by a lock for the same reason.
+    """
+
+    def __init__(self, db, owner: str, lease_seconds: float, max_attempts: int):
+        self.db = db
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = asyncio.Lock()
+
+    async def create_job(self, chat_id: int, channels: List[str], filename: str, force_refresh: bool,
+                         priority: int) -> int:
+        async with self._lock:
+            return await create_job(self.db, chat_id, channels, filename, force_refresh, priority)
+
+    async def enqueue(self, job_id: int, channels: List[str]):
+        async with self._lock:
+            await add_tasks(self.db, job_id, channels)
+
+    async def progress(self, job_id: int) -> Tuple[int, int]:
+        return await count_tasks(self.db, job_id), await count_results(self.db, job_id)
+
+    async def lease(self, limit: int) -> List[dict]:
+        async with self._lock:
+            return await lease_tasks(self.db, self.owner, limit, self.lease_seconds, self.max_attempts)
+
+    async def complete(self, task: dict, result: str, error: str = None):
+        async with self._lock:
+            await complete_task(self.db, task['job_id'], task['username'], result, error)
+
+    async def release(self, tasks: List[dict]):
+        jobs = {}
+        for task in tasks:
+            jobs.setdefault(task['job_id'], []).append(task['username'])
+        async with self._lock:
+            for job_id, usernames in jobs.items():
+                await release_tasks(self.db, job_id, usernames)
+
+    async def unfinished(self, job_id: int) -> int:
+        return await count_unfinished(self.db, job_id, self.max_attempts)
+
+    async def close(self):
+        await self.db.close()
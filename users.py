@@ -0,0 +1,136 @@
+# Standard library imports
+from typing import AsyncIterator, List, Optional, Tuple
+
+CREATE_USERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        chat_id INTEGER,
+        first_seen REAL,
+        last_seen REAL,
+        checks INTEGER NOT NULL DEFAULT 0,
+        api_token TEXT
+    )
+"""
+
+# Columns added after the first release, for databases created before them.
+USER_COLUMNS = {
+    "first_seen": "REAL",
+    "last_seen": "REAL",
+    "checks": "INTEGER NOT NULL DEFAULT 0",
+    "api_token": "TEXT",
+}
+
+# Created after USER_COLUMNS are in place.
+CREATE_USERS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS users_last_seen ON users (last_seen)",
+    "CREATE INDEX IF NOT EXISTS users_checks ON users (checks)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_api_token ON users (api_token)",
+)
+
+USER_FIELDS = ("id", "username", "first_name", "last_name", "first_seen", "last_seen", "checks")
+_SELECT_USERS = "SELECT " + ", ".join(USER_FIELDS) + " FROM users"
+
+
+def _user(row) -> dict:
+    return dict(zip(USER_FIELDS, row))
+
+
+async def _fetch(db, query: str, params: tuple) -> List[dict]:
+    cursor = await db.execute(query, params)
+    rows = await cursor.fetchall()
+    await cursor.close()
+    return [_user(row) for row in rows]
+
+
+async def get_users_page(db, after_id: int = None, before_id: int = None,
+                         limit: int = 20) -> Tuple[List[dict], bool, bool]:
+    """Returns a page of users ordered by id, and whether there are pages before and after it.
+
+    The page starts after `after_id` or ends before `before_id` (keyset
+    pagination), so no page needs to skip over the rows in front of it.
+    """
+
+    if before_id is not None:
+        users = await _fetch(db, f"{_SELECT_USERS} WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit + 1))
+        has_previous = len(users) > limit
+        return users[:limit][::-1], has_previous, True
+
+    if after_id is None:
+        users = await _fetch(db, f"{_SELECT_USERS} ORDER BY id LIMIT ?", (limit + 1,))
+    else:
+        users = await _fetch(db, f"{_SELECT_USERS} WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit + 1))
+    return users[:limit], after_id is not None, len(users) > limit
+
+
+async def search_users(db, query: str, limit: int = 20) -> List[dict]:
+    """Finds users by id or by the beginning of their username (without case)."""
+
+    query = query.strip().lstrip("@")
+    if not query:
+        return []
+    if query.isdigit():
+        return await _fetch(db, f"{_SELECT_USERS} WHERE id = ?", (int(query),))
+    # A range on the NOCASE index instead of LIKE, which could not use it. NOCASE
+    # compares lowercase, so the bound is built from the lowercase query ('Z' + 1 is '[').
+    query = query.lower()
+    upper = query[:-1] + chr(ord(query[-1]) + 1)
+    return await _fetch(db, f'''
+        {_SELECT_USERS}
+        WHERE username COLLATE NOCASE >= ? AND username COLLATE NOCASE < ?
+        ORDER BY username COLLATE NOCASE LIMIT ?
+    ''', (query, upper, limit))
+
+
+async def get_top_users(db, limit: int = 20) -> List[dict]:
+    """Returns the users that checked the most channels."""
+    return await _fetch(db, f"{_SELECT_USERS} WHERE checks > 0 ORDER BY checks DESC LIMIT ?", (limit,))
+
+
+async def count_users(db, since: Optional[float] = None) -> int:
+    """Counts all users, or those seen since the given time."""
+
+    if since is None:
+        cursor = await db.execute("SELECT COUNT(*) FROM users")
+    else:
+        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE last_seen >= ?", (since,))
+    count = (await cursor.fetchone())[0]
+    await cursor.close()
+    return count
+
+
+async def iter_users(db, page_size: int = 1000) -> AsyncIterator[dict]:
+    """Yields every user ordered by id, page by page."""
+
+    last_id = None
+    while True:
+        users, _, has_next = await get_users_page(db, after_id=last_id, limit=page_size)
+        for user in users:
+            yield user
+        if not has_next:
+            return
+        last_id = users[-1]['id']
+
+
+async def add_checks(db, user_id: int, count: int):
+    """Adds to the number of channels the user has asked to check."""
+
+    await db.execute("UPDATE users SET checks = checks + ? WHERE id = ?", (count, user_id))
+    await db.commit()
+
+
+async def set_api_token(db, user_id: int, token_hash: str):
+    """Gives the user a new API token (stored hashed), replacing the old one."""
+
+    await db.execute("UPDATE users SET api_token = ? WHERE id = ?", (token_hash, user_id))
+    await db.commit()
+
+
+async def get_user_by_token(db, token_hash: str) -> Optional[int]:
+    cursor = await db.execute("SELECT id FROM users WHERE api_token = ?", (token_hash,))
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0] if row else None
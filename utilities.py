@@ -1,5 +1,5 @@
 # Local imports
-from main import get_db, generate_keyboard
+from database import DATABASE
 
 # Standart libraries
 import logging
@@ -7,8 +7,12 @@ import time
 
 # Third-party libraries
 from datetime import datetime
-from typing import List
-from aiogram import types
+from typing import TYPE_CHECKING
+
+# aiogram is only needed by the functions that use it, so importing the
+# helpers stays cheap.
+if TYPE_CHECKING:
+    from aiogram import types
 
 
 
@@ -18,8 +22,12 @@ Welcome to the Channel Comment Checker Bot!
 This bot can check if a Telegram channel has an open comments section. You can either send a list of channels or a file containing a list of channels, and the bot will check if they have open comments sections.
 
 To use the bot:
-1. Send a message with a list of channels (e.g. @channel1 @channel2 @channel3)
+1. Send a message with a list of channels (e.g. @channel1 @channel2 @channel3, t.me/channel4 or tgstat links)
 2. Or, upload a file containing a list of channels
+3. Start the message (or the file caption) with /refresh to ignore recently cached results
+4. Send /export [opened|closed|errors|unchecked|all] [txt|csv|jsonl] to get the latest results as a file
+5. Send /watch @channel1 @channel2 to be notified when their comments open or close, /unwatch to stop
+6. Send /api_token to get a token for the batch-check HTTP API, if the bot runs one
 
 -------------------------------------------
 
@@ -29,8 +37,12 @@ To use the bot:
 Этот бот может проверить, открыт ли раздел комментариев телеграм-канала. Вы можете отправить список каналов или файл, содержащий список каналов, и бот проверит, есть ли у них открытые разделы комментариев.
 
 Как пользоваться ботом:
-1. Отправьте сообщение со списком каналов (например, @channel1 @channel2 @channel3)
+1. Отправьте сообщение со списком каналов (например, @channel1 @channel2 @channel3, t.me/channel4 или ссылки tgstat)
 2. Или загрузите файл, содержащий список каналов
+3. Начните сообщение (или подпись к файлу) с /refresh, чтобы не использовать недавние результаты из кэша
+4. Отправьте /export [opened|closed|errors|unchecked|all] [txt|csv|jsonl], чтобы получить последние результаты файлом
+5. Отправьте /watch @channel1 @channel2, чтобы получать уведомления, когда комментарии открываются или закрываются, /unwatch — чтобы перестать
+6. Отправьте /api_token, чтобы получить токен для HTTP API пакетной проверки, если бот его запускает
 """
 
 
@@ -45,21 +57,36 @@ def get_sleep_time(num_channels: int) -> int:
     elif num_channels < 90:
         return 600
 
+def generate_keyboard(job_id: int):
+    from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("View checked", callback_data="view_checked"),
+                 InlineKeyboardButton("Cancel", callback_data=f"cancel:{job_id}"))
+    return keyboard
+
 def generate_progress_bar(current: int, total: int, length: int = 12) -> str:
     """Generates a progress bar as a string of blocks."""
 
-    proportion = current / total
+    proportion = current / total if total else 1
     progress = int(proportion * length)
 
     return '▓' * progress + '░' * (length - progress)
 
-def generate_progress_message(current: int, total: int, elapsed_time: float):
-    """Generates a progress message with the current progress and estimated time remaining."""
+def generate_progress_message(current: int, total: int, elapsed_time: float, seconds_per_channel: float = None):
+    """Generates a progress message with the current progress and estimated time remaining.
+
+    When `seconds_per_channel` is given (e.g. a moving average of recent checks),
+    it is used for the ETA instead of the mean over the whole elapsed time.
+    """
 
-    estimated_time_remaining = (elapsed_time / current) * (total - current) if current > 0 else 0
+    if seconds_per_channel is not None:
+        estimated_time_remaining = seconds_per_channel * (total - current)
+    else:
+        estimated_time_remaining = (elapsed_time / current) * (total - current) if current > 0 else 0
     estimated_minutes, estimated_seconds = divmod(estimated_time_remaining, 60)
 
-    percentage = int((current / total) * 100)
+    percentage = int((current / total) * 100) if total else 100
 
     progress_bar = generate_progress_bar(current, total)
 
@@ -69,33 +96,20 @@ def generate_progress_message(current: int, total: int, elapsed_time: float):
     return progress_message
 
 
-async def add_user(user: types.User):
-    async with get_db() as db:
-        await db.execute('''
-            INSERT OR IGNORE INTO users(id, username, first_name, last_name)
-            VALUES(?, ?, ?, ?)
-        ''', (user.id, user.username, user.first_name, user.last_name))
-        await db.commit()
+def format_user(user: dict) -> str:
+    """Formats a row of the users table as one line for the admin."""
 
+    name = " ".join(part for part in (user['first_name'], user['last_name']) if part)
+    username = f"@{user['username']}" if user['username'] else "no username"
+    last_seen = datetime.utcfromtimestamp(user['last_seen']).strftime("%Y-%m-%d") if user['last_seen'] else "-"
+    return f"{user['id']} {username} {name}, checks: {user['checks']}, last seen: {last_seen}"
 
-async def get_users() -> List[dict]:
-    logging.info("Getting users from the database...")
-    users = []
-    async with get_db() as db:
-        cursor = await db.cursor()
-        await cursor.execute("SELECT * FROM users")
-        rows = await cursor.fetchall()
 
-    for row in rows:
-        users.append(
-            {"id": row[0], "username": row[1],
-                "first_name": row[2], "last_name": row[3]}
-        )
-    logging.info("Finished getting users from the database.")
-    return users
+async def add_user(user: "types.User"):
+    DATABASE.add_user(user.id, user.username, user.first_name, user.last_name)
 
 
-async def show_results(message: types.Message, latest_data, description: str):
+async def show_results(message: "types.Message", latest_data, description: str):
     logging.info("Showing results...")
     text = f"{description}:\n\n"
     for channel in latest_data:
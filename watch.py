@@ -0,0 +1,92 @@
+# Standard library imports
+import time
+from typing import Dict, List, Optional
+
+CREATE_WATCHED_CHANNELS_TABLE = """
+    CREATE TABLE IF NOT EXISTS watched_channels (
+        chat_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        status TEXT,
+        checked_at REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, username)
+    )
+"""
+
+# Lets the scheduler pick the channels that were checked longest ago.
+CREATE_WATCHED_CHANNELS_INDEX = """
+    CREATE INDEX IF NOT EXISTS watched_channels_checked ON watched_channels (checked_at)
+"""
+
+
+async def watch_channels(db, chat_id: int, usernames: List[str], limit: int = 0) -> int:
+    """Adds channels to the watch list of a chat and returns how many were added.
+
+    With a `limit` the list never grows beyond that many channels.
+    """
+
+    if limit:
+        room = max(0, limit - await count_watched(db, chat_id))
+        usernames = usernames[:room]
+    cursor = await db.executemany('''
+        INSERT OR IGNORE INTO watched_channels(chat_id, username) VALUES(?, ?)
+    ''', ((chat_id, username.lower()) for username in usernames))
+    added = cursor.rowcount
+    await db.commit()
+    return added
+
+
+async def unwatch_channels(db, chat_id: int, usernames: Optional[List[str]] = None) -> int:
+    """Removes the given channels, or all of them, from the watch list of a chat."""
+
+    if usernames is None:
+        cursor = await db.execute("DELETE FROM watched_channels WHERE chat_id = ?", (chat_id,))
+    else:
+        cursor = await db.executemany('''
+            DELETE FROM watched_channels WHERE chat_id = ? AND username = ?
+        ''', ((chat_id, username.lower()) for username in usernames))
+    removed = cursor.rowcount
+    await db.commit()
+    return removed
+
+
+async def count_watched(db, chat_id: int = None) -> int:
+    """Counts the watched channels of a chat, or the distinct ones of all chats."""
+
+    if chat_id is None:
+        cursor = await db.execute("SELECT COUNT(DISTINCT username) FROM watched_channels")
+    else:
+        cursor = await db.execute("SELECT COUNT(*) FROM watched_channels WHERE chat_id = ?", (chat_id,))
+    count = (await cursor.fetchone())[0]
+    await cursor.close()
+    return count
+
+
+async def get_due_channels(db, max_age: float, limit: int) -> List[str]:
+    """Returns up to `limit` watched usernames not checked for `max_age` seconds, stalest first."""
+
+    cursor = await db.execute('''
+        SELECT username FROM watched_channels
+        GROUP BY username HAVING MIN(checked_at) <= ?
+        ORDER BY MIN(checked_at) LIMIT ?
+    ''', (time.time() - max_age, limit))
+    usernames = [row[0] for row in await cursor.fetchall()]
+    await cursor.close()
+    return usernames
+
+
+async def update_watched(db, username: str, status: Optional[str]) -> Dict[int, Optional[str]]:
+    """Stores a new check of a watched channel for every chat that watches it.
+
+    A `status` of None (the check failed) only marks the channel as checked.
+    Returns the previous status per chat id.
+    """
+
+    cursor = await db.execute(
+        "SELECT chat_id, status FROM watched_channels WHERE username = ?", (username,))
+    previous = {row[0]: row[1] for row in await cursor.fetchall()}
+    await cursor.close()
+    await db.execute('''
+        UPDATE watched_channels SET status = COALESCE(?, status), checked_at = ? WHERE username = ?
+    ''', (status, time.time(), username))
+    await db.commit()
+    return previous